@@ -0,0 +1,407 @@
+"""
+Benchmarks for the clip pipeline and the merge, on synthetic clips.
+
+The corpus is generated locally with ffmpeg lavfi sources, so runs are
+reproducible on any machine. Results are written as JSON and can be compared
+against a previous run with --baseline.
+
+    python benchmark.py --output bench_results.json
+    python benchmark.py --baseline bench_results.json
+"""
+
+import os
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import subprocess
+from datetime import datetime
+
+import yaml
+
+import probe
+from probe import probe_video
+from labels import label_image, resolve_font
+from encoders import encoder_from_config
+from render_pool import RenderPool
+from merge_videos import (
+    process_video,
+    process_a_video,
+    merge_videos,
+    format_date_no_leading_zero,
+)
+
+
+# name, width, height, framerate, HDR transfer (None for SDR), rotation, audio
+CORPUS = [
+    ("sdr_720p30", 1280, 720, 30, None, 0, True),
+    ("sdr_1080p60_noaudio", 1920, 1080, 60, None, 0, False),
+    ("sdr_1080p24_rotated", 1920, 1080, 24, None, -90, True),
+    ("hdr_pq_2160p30", 3840, 2160, 30, "smpte2084", 0, True),
+    ("hdr_hlg_1080p30_rotated", 1920, 1080, 30, "arib-std-b67", -90, True),
+    ("hdr_hlg_2160p60_noaudio", 3840, 2160, 60, "arib-std-b67", 0, False),
+]
+
+
+def run_ffmpeg(ffmpeg_command):
+    result = subprocess.run(
+        ffmpeg_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    if result.returncode != 0:
+        print(result.stderr.decode())
+        raise RuntimeError(
+            f"ffmpeg command failed with return code {result.returncode}"
+        )
+
+
+def build_clip(path, width, height, framerate, transfer, rotation, audio, duration):
+    """
+    Generate one synthetic clip, tagged like a phone recording would be.
+    """
+    inputs = ["-f", "lavfi", "-i", f"testsrc2=s={width}x{height}:r={framerate}"]
+    maps = ["-map", "0:v"]
+    if audio:
+        inputs += ["-f", "lavfi", "-i", "sine=frequency=440:sample_rate=48000"]
+        maps += ["-map", "1:a", "-c:a", "aac", "-ac", "2"]
+
+    if transfer is None:
+        video_args = ["-c:v", "libx264", "-pix_fmt", "yuv420p"]
+    else:
+        # 10-bit HEVC tagged as BT.2020 with PQ or HLG, like iPhone HDR video
+        video_args = [
+            "-c:v",
+            "libx265",
+            "-pix_fmt",
+            "yuv420p10le",
+            "-x265-params",
+            "log-level=error",
+            "-color_primaries",
+            "bt2020",
+            "-color_trc",
+            transfer,
+            "-colorspace",
+            "bt2020nc",
+            "-tag:v",
+            "hvc1",
+        ]
+
+    unrotated_path = path.replace(".mp4", "_unrotated.mp4") if rotation else path
+    run_ffmpeg(
+        [
+            "ffmpeg",
+            "-y",
+            *inputs,
+            *maps,
+            *video_args,
+            "-preset",
+            "ultrafast",
+            "-t",
+            str(duration),
+            unrotated_path,
+        ]
+    )
+
+    if rotation:
+        # Tag the rotation as display matrix side data without re-encoding
+        run_ffmpeg(
+            [
+                "ffmpeg",
+                "-y",
+                "-display_rotation",
+                str(rotation),
+                "-i",
+                unrotated_path,
+                "-c",
+                "copy",
+                path,
+            ]
+        )
+        os.remove(unrotated_path)
+
+
+def build_corpus(corpus_path, duration):
+    """
+    Generate the corpus once; clips that already exist are reused.
+    """
+    os.makedirs(corpus_path, exist_ok=True)
+    clips = []
+    for name, width, height, framerate, transfer, rotation, audio in CORPUS:
+        path = os.path.join(corpus_path, f"{name}_{duration}s.mp4")
+        if not os.path.exists(path):
+            print(f"Generating {path}")
+            build_clip(
+                path, width, height, framerate, transfer, rotation, audio, duration
+            )
+        clips.append((name, path))
+    return clips
+
+
+class Timer:
+    """
+    Wall time and CPU time of this process and its children over a block.
+    """
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = self._cpu_time()
+        return self
+
+    def __exit__(self, *args):
+        self.wall = time.perf_counter() - self.wall
+        self.cpu = self._cpu_time() - self.cpu
+
+    @staticmethod
+    def _cpu_time():
+        total = 0.0
+        for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]:
+            usage = resource.getrusage(who)
+            total += usage.ru_utime + usage.ru_stime
+        return total
+
+
+def record(results, stage, case, timer, clips=1):
+    result = {
+        "stage": stage,
+        "case": case,
+        "clips": clips,
+        "wall_seconds": round(timer.wall, 4),
+        "cpu_seconds": round(timer.cpu, 4),
+        "clips_per_second": round(clips / timer.wall, 4) if timer.wall else None,
+    }
+    results.append(result)
+    print(
+        f"{stage:>12} {case:<28} {timer.wall:8.3f}s wall {timer.cpu:8.3f}s cpu"
+        f" {result['clips_per_second'] or 0:8.3f} clips/s"
+    )
+
+
+def reset_workspace(work_path):
+    shutil.rmtree(os.path.join(work_path, "tmp"), ignore_errors=True)
+    os.makedirs(os.path.join(work_path, "tmp", "uploads"))
+
+
+def clear_caches(config):
+    shutil.rmtree(config["cache_dir"], ignore_errors=True)
+    probe._hash_cache.clear()
+    probe._metadata_cache.clear()
+
+
+def benchmark_stages(config, clips, work_path, results, repeat):
+    """
+    Time each stage of process_a_video separately, from cold caches.
+    """
+    encoder = encoder_from_config(config)
+    date = format_date_no_leading_zero(
+        datetime(config["start_year"], config["start_month"], config["start_day"])
+    )
+    fontsize = config["font_size"]
+
+    for name, path in clips:
+        for _ in range(repeat):
+            clear_caches(config)
+            reset_workspace(work_path)
+            input_file = os.path.join(work_path, "tmp", "uploads", "1.mp4")
+            shutil.copyfile(path, input_file)
+
+            with Timer() as timer:
+                metadata = probe_video(
+                    input_file, cache_dir=os.path.join(config["cache_dir"], "probe")
+                )
+            record(results, "probe", name, timer)
+
+            with Timer() as timer:
+                probe_video(
+                    input_file, cache_dir=os.path.join(config["cache_dir"], "probe")
+                )
+            record(results, "probe_cached", name, timer)
+
+            with Timer() as timer:
+                label = label_image(
+                    date,
+                    config["font"],
+                    fontsize,
+                    fontsize // 30,
+                    config["width"],
+                    config["height"],
+                    cache_dir=os.path.join(config["cache_dir"], "labels"),
+                )
+            record(results, "label", name, timer)
+
+            with Timer() as timer:
+                process_video(
+                    input_file,
+                    input_file.replace(".mp4", "_processed.mp4"),
+                    target_width=config["width"],
+                    target_height=config["height"],
+                    text=date,
+                    framerate=config["framerate"],
+                    lossless=config["lossless_aux"],
+                    delete_intermediate_files=False,
+                    font=config["font"],
+                    fontsize=fontsize,
+                    force_video_duration_to_seconds=config[
+                        "force_video_duration_to_seconds"
+                    ],
+                    metadata=metadata,
+                    encoder=encoder,
+                    label=label,
+                )
+            record(results, "render", name, timer)
+
+            clear_caches(config)
+            reset_workspace(work_path)
+            shutil.copyfile(path, input_file)
+            with Timer() as timer:
+                process_a_video(input_file, 1, config)
+            record(results, "process", name, timer)
+
+
+def render_all(config, clips, work_path, days, workers=None):
+    """
+    Copy `days` clips from the corpus into the workspace and render them on a
+    worker pool, like the server does.
+    """
+    reset_workspace(work_path)
+    uploads = []
+    for index in range(1, days + 1):
+        _, path = clips[(index - 1) % len(clips)]
+        input_file = os.path.join(work_path, "tmp", "uploads", f"{index}.mp4")
+        shutil.copyfile(path, input_file)
+        uploads.append((input_file, index))
+
+    pool = RenderPool(config, workers=workers, max_retries=0)
+    for input_file, index in uploads:
+        pool.submit(input_file, index)
+    pool.wait()
+    if failed := pool.failed():
+        raise RuntimeError(f"{len(failed)} clip(s) failed to render")
+
+
+def benchmark_merge(config, clips, work_path, results, days):
+    for mode in ["copy", "reencode"]:
+        clear_caches(config)
+        render_all(config, clips, work_path, days)
+        with Timer() as timer:
+            merge_videos(
+                config,
+                output_combined_video="tmp/combined_video.mp4",
+                delete_intermediate_files=False,
+                lossless=config["lossless"],
+                mode=mode,
+            )
+        record(results, "merge", f"{mode}_{days}_days", timer, clips=days)
+
+
+def benchmark_end_to_end(config, clips, work_path, results, days, workers):
+    clear_caches(config)
+    with Timer() as timer:
+        render_all(config, clips, work_path, days, workers=workers)
+        merge_videos(
+            config,
+            output_combined_video="tmp/combined_video.mp4",
+            delete_intermediate_files=config["delete_intermediate_files"],
+            lossless=config["lossless"],
+        )
+    record(results, "end_to_end", f"{days}_days_{workers}_workers", timer, days)
+
+
+def environment(config):
+    result = subprocess.run(
+        ["ffmpeg", "-version"], stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    return {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "ffmpeg": result.stdout.decode().splitlines()[0],
+        "encoder": encoder_from_config(config).name,
+        "config": config,
+    }
+
+
+def compare(results, baseline_file):
+    """
+    Print how each stage changed against a previous run.
+    """
+    with open(baseline_file) as f:
+        baseline = {
+            (r["stage"], r["case"]): r["wall_seconds"] for r in json.load(f)["results"]
+        }
+
+    print(f"\nCompared to {baseline_file} (wall time, lower is better):")
+    for (stage, case), wall in aggregate(results).items():
+        if (previous := baseline.get((stage, case))) is not None and previous:
+            change = (wall - previous) / previous * 100
+            print(f"{stage:>12} {case:<28} {previous:8.3f}s -> {wall:8.3f}s {change:+6.1f}%")
+
+
+def aggregate(results):
+    # Best of the repetitions, the least noisy estimate
+    best = {}
+    for r in results:
+        key = (r["stage"], r["case"])
+        best[key] = min(best.get(key, r["wall_seconds"]), r["wall_seconds"])
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--config", default="config.yaml")
+    parser.add_argument("--work-dir", default="bench")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--baseline", help="previous results to compare against")
+    parser.add_argument("--clip-seconds", type=float, default=3)
+    parser.add_argument("--days", type=int, default=30, help="clips in merge runs")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--width", type=int, help="override the config width")
+    parser.add_argument("--height", type=int, help="override the config height")
+    parser.add_argument(
+        "--stages",
+        default="stages,merge,end_to_end",
+        help="comma separated subset of stages,merge,end_to_end",
+    )
+    args = parser.parse_args()
+
+    config = yaml.safe_load(open(args.config))
+    work_path = os.path.abspath(args.work_dir)
+    config["cache_dir"] = os.path.join(work_path, "cache")
+    config["font"] = resolve_font(config["font"])
+    # Full renders are measured on their own, not niced behind previews
+    config["preview_height"] = None
+    if args.width:
+        config["width"] = args.width
+    if args.height:
+        config["height"] = args.height
+
+    clips = build_corpus(os.path.join(work_path, "corpus"), args.clip_seconds)
+    output_file = os.path.abspath(args.output)
+    baseline_file = os.path.abspath(args.baseline) if args.baseline else None
+
+    # merge_videos works relative to the current directory, like the server
+    os.chdir(work_path)
+    results = []
+    stages = args.stages.split(",")
+    if "stages" in stages:
+        benchmark_stages(config, clips, work_path, results, args.repeat)
+    if "merge" in stages:
+        benchmark_merge(config, clips, work_path, results, args.days)
+    if "end_to_end" in stages:
+        benchmark_end_to_end(
+            config, clips, work_path, results, args.days, args.workers
+        )
+    shutil.rmtree(os.path.join(work_path, "tmp"), ignore_errors=True)
+
+    with open(output_file, "w") as f:
+        json.dump({"environment": environment(config), "results": results}, f, indent=2)
+    print(f"\nResults written to {output_file}")
+
+    if baseline_file is not None:
+        compare(results, baseline_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,14 +4,15 @@ import os
 import shutil
 import mimetypes
 import time
-from pathlib import Path
 import threading
 import yaml
 import socket
 from tqdm import tqdm
 import urllib
 
-from merge_videos import process_a_video, merge_videos
+from merge_videos import merge_videos
+from render_pool import RenderPool
+from labels import resolve_font
 
 
 # To avoid printing HTTP requests
@@ -35,9 +36,10 @@ def get_lan_ip():
 
 
 config = yaml.safe_load(open("config.yaml"))
+# Look the font up once rather than for every clip
+config["font"] = resolve_font(config["font"])
 
 # Shared progress variables
-processing_lock = threading.Lock()
 progress_lock = threading.Lock()
 total_received = 0
 total_completed = 0
@@ -48,12 +50,19 @@ progress_bar_received = None
 progress_bar_completed = None
 
 
-def self_process_video(video_file, file_index):
-    global total_completed, progress_bar_completed
-    process_a_video(video_file, int(file_index), config)
+def on_video_processed(job):
+    global total_completed
+    with progress_lock:
+        total_completed += 1
+        progress_bar_completed.update(1)
 
-    total_completed += 1
-    progress_bar_completed.update(1)
+
+render_pool = RenderPool(
+    config,
+    workers=config.get("render_workers"),
+    max_retries=config.get("render_retries", 1),
+    on_complete=on_video_processed,
+)
 
 
 def simulate_request_for_video(file_index):
@@ -72,19 +81,24 @@ def simulate_request_for_video(file_index):
     total_received += 1
     progress_bar_received.update(1)
 
-    Path(video_file.replace(".mp4", ".lock")).touch()
-    self_process_video(video_file, file_index)
+    render_pool.submit(video_file, file_index)
 
 
 def simulate_request_for_merge():
 
     file_path = "tmp/combined_video.mp4"
 
+    render_pool.wait()
+    if failed := render_pool.failed():
+        print(
+            "Merging without videos that failed to render: "
+            + ", ".join(str(job.index) for job in failed)
+        )
+
     if progress_bar_received:
         progress_bar_received.close()
         progress_bar_completed.close()
 
-    Path("tmp/process.lock").touch()
     merge_videos(
         **{
             "config": config,
@@ -0,0 +1,247 @@
+import os
+import re
+import json
+import shutil
+import threading
+
+from merge_videos import conform_clip, find_nonconforming_clips
+from instrumentation import run_instrumented
+from workspace import disk_space
+
+
+# Config values that change how a clip is rendered. If any of them changes,
+# the clips in the store no longer match and everything is rendered again.
+RENDER_SETTINGS = [
+    "start_day",
+    "start_month",
+    "start_year",
+    "width",
+    "height",
+    "framerate",
+    "font",
+    "font_size",
+    "lossless_aux",
+    "force_video_duration_to_seconds",
+    "encoder",
+    "codec",
+    "loudness_target",
+]
+
+
+class DiaryStore:
+    """
+    Rendered clips and the combined video, kept across sessions.
+
+    Clips are stored by day index next to a manifest recording the hash of the
+    source each clip was rendered from and which days the combined video
+    already contains, so a new session only renders and appends new days.
+    """
+
+    def __init__(self, path, config):
+        self.path = path
+        self.config = config
+        self.clips_path = os.path.join(path, "clips")
+        self.combined_video = os.path.join(path, "combined.mp4")
+        self.manifest_file = os.path.join(path, "manifest.json")
+        self.lock = threading.RLock()
+
+        os.makedirs(self.clips_path, exist_ok=True)
+        self.manifest = self._load_manifest()
+
+        settings = self._render_settings()
+        if self.manifest["render_settings"] != settings:
+            if self.manifest["clips"]:
+                print("Render settings changed, discarding the stored diary")
+            self._clear()
+            self.manifest["render_settings"] = settings
+            self._save_manifest()
+
+    def _render_settings(self):
+        return {key: self.config.get(key) for key in RENDER_SETTINGS}
+
+    def _load_manifest(self):
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file) as f:
+                return json.load(f)
+        return {"render_settings": None, "clips": {}, "combined": []}
+
+    def _save_manifest(self):
+        tmp_file = self.manifest_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_file, self.manifest_file)
+
+    def _clear(self):
+        for file in os.listdir(self.clips_path):
+            os.remove(os.path.join(self.clips_path, file))
+        if os.path.exists(self.combined_video):
+            os.remove(self.combined_video)
+        self.manifest["clips"] = {}
+        self.manifest["combined"] = []
+
+    def clip_path(self, index):
+        return os.path.join(self.clips_path, f"{int(index)}.mp4")
+
+    def indices(self):
+        with self.lock:
+            return sorted(int(index) for index in self.manifest["clips"])
+
+    def has_clip(self, index, source_hash=None):
+        """
+        Whether day `index` is already rendered, from the same source if given.
+        """
+        with self.lock:
+            clip = self.manifest["clips"].get(str(int(index)))
+            if clip is None:
+                return False
+            return source_hash is None or clip["source_hash"] in [None, source_hash]
+
+    def add_clip(self, index, rendered_file, source_hash=None):
+        """
+        Move a rendered clip into the store, replacing any previous one.
+        """
+        index = int(index)
+        with self.lock:
+            shutil.move(rendered_file, self.clip_path(index))
+            self.manifest["clips"][str(index)] = {"source_hash": source_hash}
+
+            # A replaced day means the combined video has to be rebuilt
+            if index in self.manifest["combined"]:
+                self.manifest["combined"] = []
+            self._save_manifest()
+
+    def _conform_clips(self, indices):
+        """
+        Re-encode the stored clips that differ from the others, returning
+        their indices.
+        """
+        clip_files = {self.clip_path(index): index for index in indices}
+        nonconforming, metadata = find_nonconforming_clips(
+            self.config, list(clip_files)
+        )
+        for clip_file in nonconforming:
+            print(f"Re-encoding {clip_file} so it can be stream copied")
+            conformed_file = clip_file.replace(".mp4", "_conformed.mp4")
+            with disk_space(self.config).reserve(
+                os.path.getsize(clip_file), conformed_file
+            ):
+                conform_clip(
+                    clip_file,
+                    conformed_file,
+                    self.config,
+                    metadata[clip_file],
+                    lossless=self.config["lossless_aux"],
+                )
+            os.replace(conformed_file, clip_file)
+        return [clip_files[clip_file] for clip_file in nonconforming]
+
+    def _concat(self, input_files, output_file):
+        list_file = os.path.join(self.path, "videos_to_merge.txt")
+        with open(list_file, "w") as f:
+            for input_file in input_files:
+                f.write(f"file '{os.path.relpath(input_file, self.path)}'\n")
+
+        ffmpeg_command = [
+            "ffmpeg",
+            "-y",
+            "-f",
+            "concat",
+            "-safe",
+            "0",
+            "-i",
+            list_file,
+            "-map",
+            "0:v:0",
+            "-map",
+            "0:a:0",
+            "-c",
+            "copy",
+            "-movflags",
+            "+faststart",
+            output_file,
+        ]
+        print("\nRunning merge command:")
+        print(" ".join(ffmpeg_command))
+        result = run_instrumented(
+            "merge", ffmpeg_command, inputs=input_files, outputs=[output_file]
+        )
+        os.remove(list_file)
+
+        if result.returncode != 0:
+            print(f"Error merging videos: {result.stderr.decode()}")
+            raise RuntimeError(
+                f"ffmpeg merge command failed with return code {result.returncode}"
+            )
+
+    def update_combined(self):
+        """
+        Bring the combined video up to date with the stored clips.
+
+        New days after the last combined one are appended to the existing
+        combined video; anything else rebuilds it from the stored clips. Both
+        are stream copies, so no clip is ever encoded again.
+        """
+        with self.lock:
+            indices = self.indices()
+            combined = self.manifest["combined"]
+            new_indices = [index for index in indices if index not in combined]
+            if not new_indices and os.path.exists(self.combined_video):
+                return self.combined_video
+            if not indices:
+                raise RuntimeError("There are no clips to merge")
+
+            # Compare against every stored clip, not just the new ones
+            if any(index in combined for index in self._conform_clips(indices)):
+                combined = []
+
+            appending = (
+                combined
+                and os.path.exists(self.combined_video)
+                and min(new_indices) > max(combined)
+            )
+            if appending:
+                input_files = [self.combined_video] + [
+                    self.clip_path(index) for index in new_indices
+                ]
+            else:
+                input_files = [self.clip_path(index) for index in indices]
+
+            # The new combined video is about the size of its inputs
+            tmp_file = self.combined_video.replace(".mp4", "_tmp.mp4")
+            size = sum(os.path.getsize(input_file) for input_file in input_files)
+            with disk_space(self.config).reserve(size, tmp_file):
+                self._concat(input_files, tmp_file)
+            os.replace(tmp_file, self.combined_video)
+
+            self.manifest["combined"] = indices
+            self._save_manifest()
+            return self.combined_video
+
+
+def merge_into_diary(
+    store,
+    folder_path="tmp/uploads",
+    output_combined_video="tmp/combined_video.mp4",
+    source_hashes=None,
+):
+    """
+    Move the clips rendered in this session into the store, extend the stored
+    combined video and link it to `output_combined_video`.
+    """
+    source_hashes = source_hashes or {}
+    for file in os.listdir(folder_path):
+        if match := re.match(r"(\d+)_processed\.(mp4|MP4)$", file):
+            index = int(match.group(1))
+            store.add_clip(
+                index, os.path.join(folder_path, file), source_hashes.get(index)
+            )
+
+    combined_video = store.update_combined()
+
+    if os.path.exists(output_combined_video):
+        os.remove(output_combined_video)
+    try:
+        os.link(combined_video, output_combined_video)
+    except OSError:
+        shutil.copyfile(combined_video, output_combined_video)
+
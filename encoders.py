@@ -0,0 +1,243 @@
+import subprocess
+from functools import lru_cache
+
+
+class EncoderBackend:
+    """
+    How to encode (and decode) video with a given ffmpeg encoder.
+
+    `lossless` config values map to each encoder's own rate control: True for
+    lossless, a number n for quantizer n - 1 (or the closest equivalent), and
+    False for the encoder defaults.
+    """
+
+    name = None
+    codec = None
+    hardware = False
+    hwaccel = None
+    presets = {}
+
+    def decode_args(self):
+        return ["-hwaccel", self.hwaccel] if self.hwaccel else []
+
+    def quality_args(self, lossless):
+        raise NotImplementedError
+
+    def preset_args(self, purpose):
+        preset = self.presets.get(purpose)
+        return ["-preset", preset] if preset else []
+
+    def gop_args(self, framerate):
+        """
+        A keyframe at the start of every clip and closed GOPs of one second.
+        """
+        return ["-g", str(framerate), "-flags", "+cgop"]
+
+    def video_args(self, lossless, purpose="final", framerate=None):
+        """
+        Encoder arguments; `purpose` is "intermediate" for clips that are
+        encoded again later, "final" for the output, or "preview".
+        """
+        args = ["-c:v", self.name]
+        args += self.quality_args(lossless)
+        args += self.preset_args(purpose)
+        if framerate is not None:
+            args += self.gop_args(framerate)
+        return args
+
+
+class X264Backend(EncoderBackend):
+    name = "libx264"
+    codec = "h264"
+    presets = {"intermediate": "veryfast", "final": "medium", "preview": "ultrafast"}
+
+    def quality_args(self, lossless):
+        if lossless == True:
+            return ["-qp", "0"]
+        if lossless != False:
+            return ["-crf", str(lossless - 1)]
+        return []
+
+
+class X265Backend(EncoderBackend):
+    name = "libx265"
+    codec = "hevc"
+    presets = {"intermediate": "veryfast", "final": "medium", "preview": "ultrafast"}
+
+    def quality_args(self, lossless):
+        if lossless == True:
+            return []  # Set through -x265-params in video_args
+        if lossless != False:
+            return ["-crf", str(lossless - 1)]
+        return []
+
+    def gop_args(self, framerate):
+        return ["-g", str(framerate)]
+
+    def video_args(self, lossless, purpose="final", framerate=None):
+        # x265 takes lossless mode and closed GOPs as its own parameters
+        x265_params = ["log-level=error"]
+        if lossless == True:
+            x265_params.append("lossless=1")
+        if framerate is not None:
+            x265_params.append("open-gop=0")
+        return super().video_args(lossless, purpose, framerate) + [
+            "-x265-params",
+            ":".join(x265_params),
+            # Makes HEVC in MP4 playable on Apple devices
+            "-tag:v",
+            "hvc1",
+        ]
+
+
+class NvencBackend(EncoderBackend):
+    name = "h264_nvenc"
+    codec = "h264"
+    hardware = True
+    hwaccel = "cuda"
+    presets = {"intermediate": "p2", "final": "p5", "preview": "p1"}
+
+    def quality_args(self, lossless):
+        if lossless != False:
+            return ["-qp", "0" if lossless == True else str(lossless - 1)]
+        return []
+
+    def gop_args(self, framerate):
+        return ["-g", str(framerate), "-forced-idr", "1", "-flags", "+cgop"]
+
+
+class HevcNvencBackend(NvencBackend):
+    name = "hevc_nvenc"
+    codec = "hevc"
+
+    def video_args(self, lossless, purpose="final", framerate=None):
+        return super().video_args(lossless, purpose, framerate) + ["-tag:v", "hvc1"]
+
+
+class QsvBackend(EncoderBackend):
+    name = "h264_qsv"
+    codec = "h264"
+    hardware = True
+    hwaccel = "qsv"
+    presets = {"intermediate": "veryfast", "final": "medium", "preview": "veryfast"}
+
+    def quality_args(self, lossless):
+        if lossless != False:
+            # QSV has no lossless mode; use its best ICQ quality instead
+            return ["-global_quality", "1" if lossless == True else str(lossless - 1)]
+        return []
+
+    def gop_args(self, framerate):
+        return ["-g", str(framerate), "-idr_interval", "0"]
+
+
+class HevcQsvBackend(QsvBackend):
+    name = "hevc_qsv"
+    codec = "hevc"
+
+    def video_args(self, lossless, purpose="final", framerate=None):
+        return super().video_args(lossless, purpose, framerate) + ["-tag:v", "hvc1"]
+
+
+# In order of preference for each codec when the encoder is "auto"
+BACKENDS = [
+    NvencBackend,
+    HevcNvencBackend,
+    QsvBackend,
+    HevcQsvBackend,
+    X264Backend,
+    X265Backend,
+]
+
+
+def _ffmpeg_listing(flag):
+    result = subprocess.run(
+        ["ffmpeg", "-hide_banner", flag],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    return result.stdout.decode().splitlines()
+
+
+@lru_cache(maxsize=None)
+def available_encoders():
+    """
+    Names of the video encoders this ffmpeg build was compiled with.
+    """
+    encoders = set()
+    for line in _ffmpeg_listing("-encoders"):
+        fields = line.split()
+        # Lines look like " V....D libx264   libx264 H.264 / AVC / ..."
+        if (
+            len(fields) >= 2
+            and fields[0].startswith("V")
+            and len(fields[0]) == 6
+            and fields[1] != "="
+        ):
+            encoders.add(fields[1])
+    return encoders
+
+
+@lru_cache(maxsize=None)
+def available_hwaccels():
+    lines = _ffmpeg_listing("-hwaccels")
+    return {line.strip() for line in lines[1:] if line.strip()}
+
+
+@lru_cache(maxsize=None)
+def encoder_works(name):
+    """
+    Whether the encoder can actually be used, i.e. the hardware is there.
+    """
+    result = subprocess.run(
+        [
+            "ffmpeg",
+            "-hide_banner",
+            "-f",
+            "lavfi",
+            "-i",
+            "color=black:s=256x256:d=0.1",
+            "-frames:v",
+            "1",
+            "-c:v",
+            name,
+            "-f",
+            "null",
+            "-",
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    return result.returncode == 0
+
+
+def backend_available(backend):
+    if backend.name not in available_encoders():
+        return False
+    if backend.hwaccel is not None and backend.hwaccel not in available_hwaccels():
+        return False
+    return not backend.hardware or encoder_works(backend.name)
+
+
+@lru_cache(maxsize=None)
+def get_encoder(encoder="auto", codec="h264"):
+    """
+    The encoder backend named `encoder`, or with "auto" the fastest one
+    available on this machine for `codec`.
+    """
+    if encoder != "auto":
+        for backend in BACKENDS:
+            if backend.name == encoder:
+                if not backend_available(backend):
+                    raise RuntimeError(f"Encoder {encoder} is not available")
+                return backend()
+        raise ValueError(f"Unknown encoder {encoder}")
+
+    for backend in BACKENDS:
+        if backend.codec == codec and backend_available(backend):
+            return backend()
+    raise RuntimeError(f"No encoder available for {codec}")
+
+
+def encoder_from_config(config):
+    return get_encoder(config.get("encoder", "auto"), config.get("codec", "h264"))
@@ -0,0 +1,196 @@
+import os
+import sys
+import json
+import time
+import shutil
+import threading
+import subprocess
+
+
+# Upper bounds of the wall time histogram buckets, in seconds
+HISTOGRAM_BUCKETS = [0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600]
+
+
+class StageStats:
+    def __init__(self):
+        self.count = 0
+        self.failures = 0
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.max_rss_bytes = 0
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self.buckets = [0] * len(HISTOGRAM_BUCKETS)
+
+    def add(self, run):
+        self.count += 1
+        self.failures += run["returncode"] != 0
+        self.wall_seconds += run["wall_seconds"]
+        # None where the platform can't tell (no wait4 on Windows)
+        if run["cpu_seconds"] is not None:
+            self.cpu_seconds += run["cpu_seconds"]
+            self.max_rss_bytes = max(self.max_rss_bytes, run["max_rss_bytes"])
+        self.input_bytes += run["input_bytes"]
+        self.output_bytes += run["output_bytes"]
+        for i, bound in enumerate(HISTOGRAM_BUCKETS):
+            if run["wall_seconds"] <= bound:
+                self.buckets[i] += 1
+
+
+class Metrics:
+    """
+    Resource usage of every instrumented subprocess, aggregated by stage.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.log_file = None
+
+    def set_log_file(self, log_file):
+        """
+        Also append every run as a JSON line to `log_file` (None to stop).
+        """
+        with self.lock:
+            if log_file is not None:
+                os.makedirs(os.path.dirname(log_file) or ".", exist_ok=True)
+            self.log_file = log_file
+
+    def record(self, run):
+        with self.lock:
+            self.stages.setdefault(run["stage"], StageStats()).add(run)
+            if self.log_file is not None:
+                with open(self.log_file, "a") as f:
+                    f.write(json.dumps(run) + "\n")
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                stage: dict(vars(stats), buckets=list(stats.buckets))
+                for stage, stats in sorted(self.stages.items())
+            }
+
+    def render(self, gauges=None):
+        """
+        The metrics in the Prometheus text format, with extra `gauges` such
+        as queue depths given as {name: value}.
+        """
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append(f"# HELP video_diary_{name} {help}")
+            lines.append(f"# TYPE video_diary_{name} {kind}")
+            for labels, value in samples:
+                lines.append(f"video_diary_{name}{labels} {value}")
+
+        stages = self.snapshot()
+
+        histogram = []
+        for stage, stats in stages.items():
+            for bound, count in zip(HISTOGRAM_BUCKETS, stats["buckets"]):
+                histogram.append((f'_bucket{{stage="{stage}",le="{bound}"}}', count))
+            histogram.append((f'_bucket{{stage="{stage}",le="+Inf"}}', stats["count"]))
+            histogram.append((f'_sum{{stage="{stage}"}}', stats["wall_seconds"]))
+            histogram.append((f'_count{{stage="{stage}"}}', stats["count"]))
+        metric(
+            "stage_wall_seconds",
+            "histogram",
+            "Wall time of each subprocess run by stage.",
+            histogram,
+        )
+
+        for name, kind, help in [
+            ("failures", "counter", "Subprocess runs that exited with an error."),
+            ("cpu_seconds", "counter", "User and system CPU time of the subprocesses."),
+            ("max_rss_bytes", "gauge", "Peak resident memory of a single run."),
+            ("input_bytes", "counter", "Bytes of the input files."),
+            ("output_bytes", "counter", "Bytes of the output files."),
+        ]:
+            metric(
+                f"stage_{name}",
+                kind,
+                help,
+                [
+                    (f'{{stage="{stage}"}}', stats[name])
+                    for stage, stats in stages.items()
+                ],
+            )
+
+        for name, value in (gauges or {}).items():
+            help = name.replace("_", " ").capitalize() + "."
+            metric(name, "gauge", help, [("", value)])
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+def _file_sizes(paths):
+    return sum(os.path.getsize(path) for path in paths if os.path.isfile(path))
+
+
+def run_instrumented(stage, command, inputs=(), outputs=(), niceness=0):
+    """
+    subprocess.run(command) with stdout and stderr captured, recording the
+    wall time, CPU time, peak memory and exit status of the child under
+    `stage`, along with the sizes of its `inputs` and `outputs` files.
+
+    A positive `niceness` runs the child at a lower CPU priority, where
+    `nice` is available.
+
+    The child is reaped with wait4, so its resource usage is its own even
+    when other threads run subprocesses at the same time. Where there is no
+    wait4 (Windows), only the wall time is recorded.
+
+    The `outputs` are deleted first. ffmpeg -y writes into an existing file,
+    which may share its bytes with a cached or stored copy (see clone_file),
+    so every run has to write a new file instead.
+    """
+    for output in outputs:
+        if output not in inputs and os.path.exists(output):
+            os.remove(output)
+
+    start = time.perf_counter()
+    program = command[0]
+    if niceness and shutil.which("nice"):
+        command = ["nice", "-n", str(niceness), *command]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    # Drain both pipes so that a chatty ffmpeg can't block on a full one
+    stderr = []
+    reader = threading.Thread(target=lambda: stderr.append(process.stderr.read()))
+    reader.start()
+    stdout = process.stdout.read()
+    reader.join()
+    process.stdout.close()
+    process.stderr.close()
+
+    cpu_seconds = max_rss_bytes = None
+    if hasattr(os, "wait4"):
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        cpu_seconds = round(usage.ru_utime + usage.ru_stime, 4)
+        # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+        max_rss_bytes = usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    else:
+        process.wait()
+    wall_seconds = time.perf_counter() - start
+
+    metrics.record(
+        {
+            "stage": stage,
+            "time": time.time(),
+            "command": program,
+            "returncode": process.returncode,
+            "wall_seconds": round(wall_seconds, 4),
+            "cpu_seconds": cpu_seconds,
+            "max_rss_bytes": max_rss_bytes,
+            "input_bytes": _file_sizes(inputs),
+            "output_bytes": _file_sizes(outputs),
+        }
+    )
+
+    return subprocess.CompletedProcess(
+        command, process.returncode, stdout, stderr[0]
+    )
@@ -0,0 +1,210 @@
+import threading
+
+
+# States of each clip
+RECEIVED = "received"
+PROCESSING = "processing"
+PROCESSED = "processed"
+# States of the combined video
+WAITING = "waiting"
+MERGING = "merging"
+READY = "ready"
+# Either can fail
+FAILED = "failed"
+
+
+class JobTracker:
+    """
+    In-memory state of a session: each clip goes received → processing →
+    processed (or failed), then the combined video goes waiting → merging →
+    ready (or failed). The preview, made of quick renders of the clips, goes
+    through the same states as the combined video.
+
+    A clip received while the combined video or preview is being merged makes
+    that merge out of date: it goes back to waiting once done, to be merged
+    again.
+
+    Every change bumps a version number and wakes up the waiters, so clients
+    can long-poll for the next change instead of polling on a timer.
+    """
+
+    def __init__(self):
+        # Reentrant, so wait_until conditions can use the methods below
+        self.lock = threading.RLock()
+        self.changed = threading.Condition(self.lock)
+        self.version = 0
+        self.total = None
+        self.clips = {}
+        self.merge_state = WAITING
+        self.merge_error = None
+        self.merge_outdated = False
+        # Merges started so far, telling one merge from the next
+        self.merge_count = 0
+        # Clips with their preview rendered (or failed)
+        self.previews = set()
+        self.preview_state = WAITING
+        self.preview_error = None
+        self.preview_outdated = False
+
+    def _bump(self):
+        self.version += 1
+        self.changed.notify_all()
+
+    def set_total(self, total):
+        with self.lock:
+            self.total = total
+            self._bump()
+
+    def set_clip(self, index, state, error=None, **details):
+        with self.lock:
+            clip = {"state": state, **details}
+            if error is not None:
+                clip["error"] = str(error)
+            self.clips[int(index)] = clip
+            if state == RECEIVED:
+                # A new clip makes the combined video and preview out of date
+                if self.merge_state in [READY, FAILED]:
+                    self.merge_state = WAITING
+                elif self.merge_state == MERGING:
+                    self.merge_outdated = True
+                if self.preview_state in [READY, FAILED]:
+                    self.preview_state = WAITING
+                elif self.preview_state == MERGING:
+                    self.preview_outdated = True
+                self.previews.discard(int(index))
+            self._bump()
+
+    def set_preview(self, index):
+        with self.lock:
+            self.previews.add(int(index))
+            self._bump()
+
+    def start_merge(self):
+        """
+        Move to merging, unless a merge is running or done already.
+        Returns whether the caller should start the merge.
+        """
+        with self.lock:
+            if self.merge_state in [MERGING, READY]:
+                return False
+            self.merge_state = MERGING
+            self.merge_error = None
+            self.merge_outdated = False
+            self.merge_count += 1
+            self._bump()
+            return True
+
+    def finish_merge(self, error=None):
+        """
+        Move to ready or failed, or back to waiting if clips were received
+        during the merge. Returns whether the merge is out of date.
+        """
+        with self.lock:
+            outdated = self.merge_outdated
+            self.merge_outdated = False
+            if outdated:
+                self.merge_state = WAITING
+                self.merge_error = None
+            else:
+                self.merge_state = READY if error is None else FAILED
+                self.merge_error = None if error is None else str(error)
+            self._bump()
+            return outdated
+
+    def start_preview_merge(self):
+        with self.lock:
+            if self.preview_state in [MERGING, READY]:
+                return False
+            self.preview_state = MERGING
+            self.preview_error = None
+            self.preview_outdated = False
+            self._bump()
+            return True
+
+    def finish_preview_merge(self, error=None):
+        with self.lock:
+            outdated = self.preview_outdated
+            self.preview_outdated = False
+            if outdated:
+                self.preview_state = WAITING
+                self.preview_error = None
+            else:
+                self.preview_state = READY if error is None else FAILED
+                self.preview_error = None if error is None else str(error)
+            self._bump()
+            return outdated
+
+    def clips_pending(self):
+        with self.lock:
+            return sum(
+                clip["state"] in [RECEIVED, PROCESSING] for clip in self.clips.values()
+            )
+
+    def _snapshot(self):
+        counts = {state: 0 for state in [RECEIVED, PROCESSING, PROCESSED, FAILED]}
+        for clip in self.clips.values():
+            counts[clip["state"]] += 1
+        return {
+            "version": self.version,
+            "state": self.merge_state,
+            "error": self.merge_error,
+            "total": self.total,
+            "counts": counts,
+            "clips": {index: dict(clip) for index, clip in sorted(self.clips.items())},
+            "preview": {
+                "state": self.preview_state,
+                "error": self.preview_error,
+                "clips": len(self.previews),
+            },
+        }
+
+    def snapshot(self):
+        with self.lock:
+            return self._snapshot()
+
+    def wait(self, since=None, timeout=None):
+        """
+        The state once its version is past `since`, or after `timeout`
+        seconds whatever it is. Without `since`, return it right away.
+        """
+        with self.lock:
+            if since is not None:
+                self.changed.wait_for(lambda: self.version > since, timeout)
+            return self._snapshot()
+
+    def wait_until(self, condition, timeout=None):
+        """
+        Block until `condition()` is true or `timeout` seconds have passed.
+        Returns the last value of `condition()`.
+        """
+        with self.lock:
+            return self.changed.wait_for(condition, timeout)
+
+    def clips_finished(self):
+        """
+        Whether every clip announced in the plan has been rendered or failed.
+        """
+        with self.lock:
+            return (
+                self.total is not None
+                and len(self.clips) >= self.total
+                and not self.clips_pending()
+            )
+
+    def can_merge(self):
+        """
+        Whether the clips can be merged: all the planned ones are rendered or
+        failed, or without a plan, every clip received so far.
+        """
+        with self.lock:
+            if self.total is not None:
+                return self.clips_finished()
+            return bool(self.clips) and not self.clips_pending()
+
+    def previews_finished(self):
+        """
+        Whether every clip announced in the plan has its preview rendered or
+        failed.
+        """
+        with self.lock:
+            return self.total is not None and len(self.previews) >= self.total
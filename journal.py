@@ -0,0 +1,74 @@
+import os
+import json
+import threading
+
+
+def read_records(path):
+    """
+    Every record written so far. A last line cut short by a crash is ignored.
+    """
+    records = []
+    with open(path) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                break
+    return records
+
+
+class Journal:
+    """
+    An append-only JSON lines log of what happened to a session, written
+    through to disk so that it survives the server being killed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.file = open(path, "a")
+
+    def append(self, event, **fields):
+        with self.lock:
+            self.file.write(json.dumps({"event": event, **fields}) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def remove(self):
+        with self.lock:
+            self.file.close()
+            os.remove(self.path)
+
+
+class SessionState:
+    """
+    The state of a session rebuilt from its journal records.
+    """
+
+    def __init__(self, records):
+        self.total = None
+        self.uploads = {}
+        self.rendered = {}
+        self.merge_started = False
+        self.merged = False
+
+        for record in records:
+            event = record["event"]
+            index = record.get("index")
+            if event == "plan":
+                self.total = record["total"]
+            elif event == "upload":
+                # A new upload of a day replaces whatever was done with it
+                self.uploads[index] = record["sha256"]
+                self.rendered.pop(index, None)
+                self.merged = False
+            elif event == "rendered":
+                self.rendered[index] = record.get("result") or {}
+            elif event == "merge_started":
+                self.merge_started = True
+                self.merged = False
+            elif event == "merged":
+                self.merged = True
+            elif event == "merge_failed":
+                self.merged = False
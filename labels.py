@@ -0,0 +1,101 @@
+import os
+import hashlib
+import threading
+import subprocess
+from functools import lru_cache
+
+from instrumentation import run_instrumented
+
+
+LABEL_CACHE_DIR = "cache/labels"
+
+
+@lru_cache(maxsize=None)
+def resolve_font(font):
+    """
+    Resolve a font name to the path of its file, so that it is looked up once
+    rather than by every ffmpeg process. Unknown fonts are returned as is.
+    """
+    if os.path.isfile(font):
+        return os.path.abspath(font)
+
+    try:
+        result = subprocess.run(
+            ["fc-match", "-f", "%{file}", font],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+    except FileNotFoundError:
+        return font
+    path = result.stdout.decode().strip()
+    return path if result.returncode == 0 and os.path.isfile(path) else font
+
+
+def label_strip_height(fontsize, target_height):
+    # Tall enough for the text, its bevel and the margin below it
+    return min(2 * fontsize, target_height)
+
+
+def label_image(
+    text, font, fontsize, bevel, target_width, target_height, cache_dir=LABEL_CACHE_DIR
+):
+    """
+    Render the date label with its bevel shadow once to a transparent PNG.
+
+    The image is a strip as wide as the video, meant to be overlaid on the
+    bottom of each frame, and is cached by everything that affects it.
+    Returns the path to the image and its height.
+    """
+    font = resolve_font(font)
+    strip_height = label_strip_height(fontsize, target_height)
+
+    key = hashlib.sha256(
+        repr((text, font, fontsize, bevel, target_width, strip_height)).encode()
+    ).hexdigest()
+    label_file = os.path.join(cache_dir, f"{key}.png")
+
+    if os.path.exists(label_file):
+        return label_file, strip_height
+
+    font_option = f"fontfile='{font}'" if os.path.isfile(font) else f"font='{font}'"
+    # Same positions as drawing on the full frame, since y is relative to
+    # the bottom edge
+    position = (fontsize // 5, -(fontsize // 5))
+    draw_text_filter = (
+        f"drawtext=text='{text}':{font_option}:fontsize={fontsize}:fontcolor=black:"
+        f"x={position[0]+bevel}:y={position[1]+bevel}+h-th,"
+        f"drawtext=text='{text}':{font_option}:fontsize={fontsize}:fontcolor=white:"
+        f"x={position[0]}:y={position[1]}+h-th"
+    )
+
+    os.makedirs(cache_dir, exist_ok=True)
+    # Unique per thread, so workers rendering the same label don't clash
+    tmp_file = label_file.replace(
+        ".png", f".{os.getpid()}.{threading.get_ident()}.tmp.png"
+    )
+    result = run_instrumented(
+        "label",
+        [
+            "ffmpeg",
+            "-y",
+            "-f",
+            "lavfi",
+            "-i",
+            f"color=c=black@0.0:s={target_width}x{strip_height},format=rgba",
+            "-vf",
+            draw_text_filter,
+            "-frames:v",
+            "1",
+            tmp_file,
+        ],
+        outputs=[tmp_file],
+    )
+
+    if result.returncode != 0:
+        print(f"Error rendering label {text}: {result.stderr.decode()}")
+        raise RuntimeError(
+            f"ffmpeg command failed with return code {result.returncode}"
+        )
+    os.replace(tmp_file, label_file)
+
+    return label_file, strip_height
@@ -3,261 +3,127 @@ import re
 import time
 from datetime import datetime, timedelta
 from tqdm import tqdm
-import subprocess
 import json
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
+from probe import PROBE_CACHE_DIR, probe_video, remember_loudness
+from instrumentation import run_instrumented
+from encoders import get_encoder, encoder_from_config
+from labels import label_image, resolve_font
+from scratch import scratch_space
+from render_cache import render_cache, render_key
+from workspace import disk_space, estimate_render_bytes
 
-def get_video_rotation(input_path):
-    # Extract rotation information from ffprobe output
-    result = subprocess.run(
-        [
-            "ffprobe",
-            "-v",
-            "0",
-            "-select_streams",
-            "v:0",
-            "-show_entries",
-            "stream_side_data=rotation",
-            "-of",
-            "default=nw=1:nk=1",
-            input_path,
-        ],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    )
-    rotation = 0
-    output = result.stdout.decode().strip()
-    try:
-        rotation = int(output)
-    except ValueError:
-        pass
-    return rotation
 
+# Tone map HDR (BT.2020 with PQ or HLG) down to 8-bit BT.709
+HDR_TO_SDR_FILTER = "zscale=t=linear:npl=100,format=gbrpf32le,zscale=p=bt709,tonemap=tonemap=hable:desat=0,zscale=t=bt709:m=bt709:r=tv,format=yuv420p"
 
-def deal_with_8bit_encoding_and_hdr(input_path, delete_intermediate_files=True):
-    """
-    Check if a video is in HDR and convert it to SDR if necessary.
-    """
 
-    # Check video metadata with ffprobe
-    result = subprocess.run(
-        [
-            "ffprobe",
-            "-v",
-            "error",
-            "-select_streams",
-            "v:0",
-            "-show_entries",
-            "stream=color_primaries,color_transfer,color_space,max_cll,master_display",
-            "-of",
-            "json",
-            input_path,
-        ],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    )
+# True peak (dBTP) and loudness range (LU) targets of loudness normalization
+LOUDNESS_TRUE_PEAK = -1.5
+LOUDNESS_RANGE = 11
 
-    metadata = json.loads(result.stdout.decode())
+# Niceness of full renders while previews are being made
+FULL_RENDER_NICENESS = 10
 
-    # Extract color metadata
-    stream_metadata = metadata.get("streams", [{}])[0]
-    color_primaries = stream_metadata.get("color_primaries", "")
-    color_transfer = stream_metadata.get("color_transfer", "")
-    color_space = stream_metadata.get("color_space", "")
+AUDIO_CODEC_ARGS = ["-c:a", "aac", "-b:a", "128k", "-ar", "44100", "-ac", "2"]
 
-    # Adjust parameters for HDR input
-    if (
-        color_primaries == "bt2020"
-        or color_transfer in ["smpte2084", "arib-std-b67"]
-        or color_space == "bt2020_ncl"
-    ):
-        output_path = input_path.replace(".mp4", "_sdr.mp4")
-
-        # Construct the ffmpeg command
-        vf_filters = "zscale=t=linear:npl=100,format=gbrpf32le,zscale=p=bt709,tonemap=tonemap=hable:desat=0,zscale=t=bt709:m=bt709:r=tv,format=yuv420p"
-
-        ffmpeg_command = [
-            "ffmpeg",
-            "-i",
-            input_path,
-            "-map",
-            "0:v:0",
-            "-map",
-            "0:a:0",
-            "-vf",
-            vf_filters,
-            "-colorspace",
-            "bt709",
-            "-c:v",
-            "libx264",
-            "-crf",
-            "18",
-            "-preset",
-            "slow",
-            "-c:a",
-            "aac",
-            "-b:a",
-            "128k",
-            "-ar",
-            "44100",
-            "-ac",
-            "2",
-            output_path,
-        ]
 
-        # Print and execute the command
-        # print("FFmpeg command:", ' '.join(ffmpeg_command))
-        result = subprocess.run(
-            ffmpeg_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-        )
+def conforming_stream_args():
+    """
+    Arguments shared by every rendered clip so that clips can be joined with a
+    stream copy, together with the encoder's GOP settings: same pixel format
+    and time base.
+    """
+    return ["-pix_fmt", "yuv420p", "-video_track_timescale", "90000"]
 
-        if result.returncode != 0:
-            print("Error during FFmpeg execution:")
-            print(result.stderr.decode())
-            raise RuntimeError("FFmpeg failed to execute the tone mapping process.")
 
-        # Optionally delete the original file
-        if delete_intermediate_files:
-            os.remove(input_path)
-        return output_path
-    return input_path
+def source_range(metadata, force_video_duration_to_seconds=None):
+    """
+    The part of the source, as (start, end) in seconds, that ends up in the clip.
+    """
+    end = metadata.duration
+    if force_video_duration_to_seconds is not None and (
+        not end or force_video_duration_to_seconds < end
+    ):
+        end = force_video_duration_to_seconds
+    return 0.0, end
 
 
-def add_empty_audio_if_missing(input_path, delete_intermediate_files=True):
+def loudnorm_filter(target, measured=None):
     """
-    Adds a silent audio track to a video if it doesn't have one.
+    An EBU R128 loudnorm filter taking audio to `target` LUFS. Without a
+    measurement it adjusts the gain as it goes and prints what it measured;
+    with the `measured` loudness of the same audio it applies a single gain,
+    which keeps the dynamics of the source.
     """
-
-    # Check if the input video has an audio stream
-    result = subprocess.run(
-        [
-            "ffprobe",
-            "-v",
-            "error",
-            "-select_streams",
-            "a",
-            "-show_entries",
-            "stream=index",
-            "-of",
-            "csv=p=0",
-            input_path,
-        ],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
+    loudnorm = f"loudnorm=I={target}:TP={LOUDNESS_TRUE_PEAK}:LRA={LOUDNESS_RANGE}"
+    if measured is None:
+        return f"{loudnorm}:print_format=json"
+    # The offset only holds for the target it was measured for
+    offset = measured["target_offset"] if measured["target"] == target else 0
+    return (
+        f"{loudnorm}:measured_I={measured['input_i']}"
+        f":measured_TP={measured['input_tp']}"
+        f":measured_LRA={measured['input_lra']}"
+        f":measured_thresh={measured['input_thresh']}"
+        f":offset={offset}:linear=true"
     )
-    if not result.stdout.strip():
-        # No audio stream found; add a silent audio track
-        video_duration = (
-            subprocess.run(
-                [
-                    "ffprobe",
-                    "-v",
-                    "error",
-                    "-show_entries",
-                    "format=duration",
-                    "-of",
-                    "csv=p=0",
-                    input_path,
-                ],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-            )
-            .stdout.decode()
-            .strip()
-        )
-
-        output_path = input_path.replace(".mp4", "_with_audio_stream.mp4")
-        result = subprocess.run(
-            [
-                "ffmpeg",
-                "-y",
-                "-i",
-                input_path,
-                "-f",
-                "lavfi",
-                "-t",
-                video_duration,
-                "-i",
-                "anullsrc=channel_layout=stereo:sample_rate=44100",
-                "-c:v",
-                "copy",
-                "-c:a",
-                "aac",
-                "-shortest",
-                output_path,
-            ],
-            check=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
 
-        if result.returncode != 0:
-            print("Error during FFmpeg execution for adding empty audio stream:")
-            print(result.stderr.decode())
-            raise RuntimeError("FFmpeg failed to execute the audio addition process.")
 
-        # Optionally delete the original file
-        if delete_intermediate_files:
-            os.remove(input_path)
-        return output_path
-    else:
-        # If audio exists, just copy the input to the output
-        return input_path
+def parse_loudnorm_output(stderr):
+    """
+    The measurement printed by a loudnorm filter with print_format=json, from
+    the log of ffmpeg. Returns None if there is none.
+    """
+    log = stderr.decode(errors="replace")
+    key = log.rfind('"input_i"')
+    start = log.rfind("{", 0, key)
+    end = log.find("}", key)
+    if key == -1 or start == -1 or end == -1:
+        return None
+    try:
+        stats = json.loads(log[start : end + 1])
+    except ValueError:
+        return None
+    return {
+        name: stats[name]
+        for name in [
+            "input_i",
+            "input_tp",
+            "input_lra",
+            "input_thresh",
+            "target_offset",
+        ]
+    }
 
 
-def process_video(
-    input_path,
-    output_path,
+def build_render_graph(
+    metadata,
     target_width,
     target_height,
-    text,
     framerate=30,
-    font="Arial",
-    fontsize=100,
-    bevel=None,
-    delete_intermediate_files=True,
-    lossless=True,
-    force_video_duration_to_seconds=None,
+    label_height=None,
+    duration=None,
+    loudness_target=None,
+    measured_loudness=None,
 ):
-    if bevel is None:
-        bevel = fontsize // 30
-
-    # Step 1: Handle missing audio
-    input_path = add_empty_audio_if_missing(
-        input_path, delete_intermediate_files=delete_intermediate_files
-    )
-
-    # Step 2: Handle HDR
-    input_path = deal_with_8bit_encoding_and_hdr(
-        input_path, delete_intermediate_files=delete_intermediate_files
-    )
-
-    # Step 3: Normalize dimensions and aspect ratio
-
-    # Get the original dimensions and rotation of the video
-    result = subprocess.run(
-        [
-            "ffprobe",
-            "-v",
-            "error",
-            "-select_streams",
-            "v:0",
-            "-show_entries",
-            "stream=width,height",
-            "-of",
-            "csv=p=0",
-            input_path,
-        ],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    )
-    width, height = map(int, result.stdout.decode().strip().split(",")[:2])
+    """
+    Build a single filter graph taking a source clip to a normalized clip.
 
-    rotation = get_video_rotation(input_path)
+    The graph reads the first video and audio streams of input 0 and produces
+    the labels [v] and [a]. Silent audio is synthesized when the source has
+    none and HDR sources are tone mapped, so everything happens in one decode.
+    If `label_height` is given, input 1 is the pre-rendered date label strip
+    of that height, overlaid on the bottom of every frame. `duration` is how
+    much of the source is used, the whole of it by default.
 
-    # Adjust dimensions based on rotation
-    if rotation in [90, -90, 270, -270]:
-        width, height = height, width
+    With `loudness_target`, the audio is normalized to that loudness, from the
+    `measured_loudness` of the source if known, or else measuring it.
+    """
+    # Dimensions as displayed, i.e. after applying the rotation
+    width, height = metadata.display_width, metadata.display_height
 
     # Calculate the scaling factors and padding to preserve aspect ratio
     aspect_ratio = width / height
@@ -277,62 +143,162 @@ def process_video(
 
     scale_filter = f"scale={scale_width}:{scale_height}"
     pad_filter = f"pad={target_width}:{target_height}:{pad_width}:{pad_height}:black"
-    position = (fontsize // 5, -(fontsize // 5))
-    draw_text_filter = (
-        f"drawtext=text='{text}':fontfile={font}:fontsize={fontsize}:fontcolor=black:"
-        f"x={position[0]+bevel}:y={position[1]+bevel}+h-th,"
-        f"drawtext=text='{text}':fontfile={font}:fontsize={fontsize}:fontcolor=white:"
-        f"x={position[0]}:y={position[1]}+h-th"
-    )
     normalized_fps_filter = f"fps={framerate}"
 
-    # Step 4: Define codec settings based on the lossless argument
-    if lossless != False:
-        video_codec = [
-            "-c:v",
-            "h264_nvenc",
-            "-qp",
-            "0" if lossless == True else str(lossless - 1),
-        ]
+    # Drop frames first so that every later filter works on as few as possible
+    video_filters = [normalized_fps_filter]
+    if metadata.is_hdr and scale_width * scale_height < width * height:
+        # Tone mapping works on float pixels, so do it on as few as possible
+        video_filters += [scale_filter, HDR_TO_SDR_FILTER]
+    elif metadata.is_hdr:
+        video_filters += [HDR_TO_SDR_FILTER, scale_filter]
+    else:
+        video_filters.append(scale_filter)
+    video_filters.append(pad_filter)
+    if label_height is None:
+        video_graph = f"[0:v:0]{','.join(video_filters)}[v]"
     else:
-        video_codec = ["-c:v", "h264_nvenc"]
+        # The label is a single image, which overlay repeats on every frame
+        video_graph = (
+            f"[0:v:0]{','.join(video_filters)}[base];"
+            f"[base][1:v]overlay=0:{target_height - label_height}[v]"
+        )
 
-    # Step 5: Define duration arguments if necessary
+    if metadata.has_audio and loudness_target is not None:
+        if measured_loudness is not None and measured_loudness["input_i"] == "-inf":
+            # Digital silence, there is nothing to normalize
+            audio_graph = "[0:a:0]anull[a]"
+        else:
+            loudnorm = loudnorm_filter(loudness_target, measured_loudness)
+            audio_graph = f"[0:a:0]{loudnorm}[a]"
+    elif metadata.has_audio:
+        audio_graph = "[0:a:0]anull[a]"
+    else:
+        # No audio stream found; synthesize a silent track as long as the video
+        audio_graph = (
+            "anullsrc=channel_layout=stereo:sample_rate=44100,"
+            f"atrim=duration={duration or metadata.duration}[a]"
+        )
+
+    return f"{video_graph};{audio_graph}"
+
+
+def process_video(
+    input_path,
+    output_path,
+    target_width,
+    target_height,
+    text,
+    framerate=30,
+    font="Arial",
+    fontsize=100,
+    bevel=None,
+    delete_intermediate_files=True,
+    lossless=True,
+    force_video_duration_to_seconds=None,
+    metadata=None,
+    encoder=None,
+    label=None,
+    purpose="intermediate",
+    niceness=0,
+    loudness_target=None,
+    probe_cache_dir=PROBE_CACHE_DIR,
+):
+    if encoder is None:
+        encoder = get_encoder()
+
+    # Probe the source once; the whole render graph is derived from this record
+    if metadata is None:
+        metadata = probe_video(input_path)
+
+    # The date label is rendered once to an image instead of on every frame
+    if label is None:
+        if bevel is None:
+            bevel = fontsize // 30
+        label = label_image(
+            text, font, fontsize, bevel, target_width, target_height
+        )
+    label_file, label_height = label
+
+    # Only this part of the source is ever decoded
+    start, end = source_range(metadata, force_video_duration_to_seconds)
+
+    # The loudness of the source is measured by the first render of this part
+    # of it, and only applied by the next ones
+    measured_loudness = None
+    measuring = False
+    if loudness_target is not None and metadata.has_audio:
+        loudness_key = f"{start:.3f}-{end:.3f}"
+        measured_loudness = metadata.loudness.get(loudness_key)
+        measuring = measured_loudness is None
+
+    # Steps 1-3: Audio synthesis, HDR tone mapping, fps, scaling, padding and
+    # the date overlay, all in one filter graph
+    filter_graph = build_render_graph(
+        metadata,
+        target_width,
+        target_height,
+        framerate=framerate,
+        label_height=label_height,
+        duration=end - start,
+        loudness_target=loudness_target,
+        measured_loudness=measured_loudness,
+    )
+
+    # SDR output from an HDR source must not keep the BT.2020 tags
+    color_args = (
+        ["-color_primaries", "bt709", "-color_trc", "bt709", "-colorspace", "bt709"]
+        if metadata.is_hdr
+        else []
+    )
+
+    # Step 4: Define codec settings based on the lossless argument; the clip
+    # is an intermediate since the merge may encode it again, unless it is
+    # for a preview
+    video_codec = encoder.video_args(lossless, purpose, framerate=framerate)
+
+    # Step 5: Define duration arguments if necessary. They are given for the
+    # input too, so decoding stops as soon as the needed range has been read
     duration_args = (
         []
         if force_video_duration_to_seconds is None
         else ["-t", str(force_video_duration_to_seconds)]
     )
 
-    # Step 6: Combine normalization, scaling, and audio in a single FFmpeg command
+    # Step 6: Render the whole clip with a single decode and a single encode
     ffmpeg_command = [
         "ffmpeg",
         "-y",
-        "-hwaccel",
-        "cuda",
+        *encoder.decode_args(),
+        *duration_args,
         "-i",
         input_path,
-        "-vf",
-        f"{normalized_fps_filter},{scale_filter},{pad_filter},{draw_text_filter}",
+        "-i",
+        label_file,
+        "-filter_complex",
+        filter_graph,
+        "-map",
+        "[v]",
+        "-map",
+        "[a]",
         *video_codec,
+        *conforming_stream_args(),
+        *color_args,
         *duration_args,
         "-vsync",
         "cfr",
         "-r",
         str(framerate),
-        "-c:a",
-        "aac",
-        "-b:a",
-        "128k",
-        "-ar",
-        "44100",
-        "-ac",
-        "2",
+        *AUDIO_CODEC_ARGS,
         output_path,
     ]
 
-    result = subprocess.run(
-        ffmpeg_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    result = run_instrumented(
+        "preview" if purpose == "preview" else "render",
+        ffmpeg_command,
+        inputs=[input_path],
+        outputs=[output_path],
+        niceness=niceness,
     )
 
     if result.returncode != 0:
@@ -341,17 +307,57 @@ def process_video(
             f"ffmpeg command failed with return code {result.returncode}"
         )
 
+    if measuring and (loudness := parse_loudnorm_output(result.stderr)) is not None:
+        remember_loudness(
+            metadata,
+            loudness_key,
+            {**loudness, "target": loudness_target},
+            cache_dir=probe_cache_dir,
+        )
+
     # Step 7: Cleanup intermediate files if necessary
     if delete_intermediate_files and input_path != output_path:
         os.remove(input_path)
 
+    return start, end
+
 
 def format_date_no_leading_zero(date):
     # This function removes leading zeros from the day
     return date.strftime("%-d %b %Y") if os.name != "nt" else date.strftime("%#d %b %Y")
 
 
-def process_a_video(input_file, index, config):
+def preview_config(config):
+    """
+    The config of preview renders: the size set by preview_height with the
+    same aspect ratio, a label scaled to match, and preview_quality.
+    """
+    height = config["preview_height"]
+    scale = height / config["height"]
+    return {
+        **config,
+        # Encoders need even dimensions
+        "width": round(config["width"] * scale / 2) * 2,
+        "height": height,
+        "font_size": max(round(config["font_size"] * scale), 1),
+        "lossless_aux": config.get("preview_quality", 30),
+        "lossless": config.get("preview_quality", 30),
+        "merge_mode": "copy",
+        "merge_segments": None,
+    }
+
+
+def process_a_video(input_file, index, config, preview=False):
+    """
+    Render one day's clip. With `preview`, render a quick low resolution
+    version of it instead. The upload is left for the caller to delete.
+    """
+    niceness = 0
+    if preview:
+        config = preview_config(config)
+    elif config.get("preview_height") is not None:
+        # Previews go first; full renders only take the CPU time left
+        niceness = FULL_RENDER_NICENESS
     start_date = datetime(
         config["start_year"], config["start_month"], config["start_day"]
     )
@@ -359,29 +365,224 @@ def process_a_video(input_file, index, config):
     common_height = config["height"]
     framerate = config["framerate"]
     lossless = config["lossless_aux"]
-    delete_intermediate_files = config["delete_intermediate_files"]
-    font = config["font"]
+    font = resolve_font(config["font"])
     fontsize = config["font_size"]
 
     date = start_date + timedelta(days=index - 1)
     date = format_date_no_leading_zero(date)
-    output_file = input_file.replace(".mp4", "_processed.mp4")
-    process_video(
-        input_file,
-        output_file,
-        target_width=common_width,
-        target_height=common_height,
-        text=date,
-        framerate=framerate,
-        lossless=lossless,
-        delete_intermediate_files=delete_intermediate_files,
-        font=font,
-        fontsize=fontsize,
-        force_video_duration_to_seconds=config["force_video_duration_to_seconds"],
+    output_file = input_file.replace(
+        ".mp4", "_preview.mp4" if preview else "_processed.mp4"
+    )
+    probe_cache_dir = os.path.join(config.get("cache_dir", "cache"), "probe")
+    metadata = probe_video(input_file, cache_dir=probe_cache_dir)
+    encoder = encoder_from_config(config)
+    force_video_duration_to_seconds = config["force_video_duration_to_seconds"]
+
+    # A render of the same source with the same settings is reused as is
+    cache = render_cache(config)
+    if cache is not None:
+        key = render_key(
+            metadata.content_hash,
+            date,
+            common_width,
+            common_height,
+            framerate,
+            font,
+            fontsize,
+            lossless,
+            force_video_duration_to_seconds,
+            encoder.name,
+            config.get("loudness_target"),
+            preview,
+        )
+        if cache.get(key, output_file):
+            start, end = source_range(metadata, force_video_duration_to_seconds)
+            return {"source_range": [start, end], "cached": True}
+
+    label = label_image(
+        date,
+        font,
+        fontsize,
+        fontsize // 30,
+        common_width,
+        common_height,
+        cache_dir=os.path.join(config.get("cache_dir", "cache"), "labels"),
+    )
+
+    # Wait for room on the disk rather than have ffmpeg fail halfway
+    start, end = source_range(metadata, force_video_duration_to_seconds)
+    size = estimate_render_bytes(
+        end - start, common_width, common_height, framerate, lossless
+    )
+    with disk_space(config).reserve(size, output_file):
+        process_video(
+            input_file,
+            output_file,
+            target_width=common_width,
+            target_height=common_height,
+            text=date,
+            framerate=framerate,
+            lossless=lossless,
+            delete_intermediate_files=False,
+            font=font,
+            fontsize=fontsize,
+            force_video_duration_to_seconds=force_video_duration_to_seconds,
+            metadata=metadata,
+            encoder=encoder,
+            label=label,
+            purpose="preview" if preview else "intermediate",
+            niceness=niceness,
+            loudness_target=config.get("loudness_target"),
+            probe_cache_dir=probe_cache_dir,
+        )
+
+    if cache is not None:
+        cache.put(key, output_file)
+
+    return {"source_range": [start, end]}
+
+
+def clip_signature(metadata):
+    """
+    Stream parameters that have to match for clips to be joined by stream copy.
+    """
+    video = metadata.video_stream
+    audio = metadata.audio_stream
+    return (
+        video.codec_name,
+        video.profile,
+        video.pix_fmt,
+        video.extradata_hash,
+        video.width,
+        video.height,
+        round(video.framerate, 3),
+        audio.codec_name if audio else None,
+        audio.sample_rate if audio else None,
+        audio.channels if audio else None,
+    )
+
+
+def conform_clip(
+    input_path, output_path, config, metadata, lossless=True, encoder=None
+):
+    """
+    Re-encode a single clip with the parameters every rendered clip shares.
+    """
+    width, height = config["width"], config["height"]
+    framerate = config["framerate"]
+    if encoder is None:
+        encoder = encoder_from_config(config)
+
+    filter_graph = (
+        f"[0:v:0]fps={framerate},"
+        f"scale={width}:{height}:force_original_aspect_ratio=decrease,"
+        f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2:black,format=yuv420p[v];"
+    )
+    if metadata.has_audio:
+        filter_graph += "[0:a:0]aresample=44100[a]"
+    else:
+        filter_graph += (
+            "anullsrc=channel_layout=stereo:sample_rate=44100,"
+            f"atrim=duration={metadata.duration}[a]"
+        )
+
+    ffmpeg_command = [
+        "ffmpeg",
+        "-y",
+        "-i",
+        input_path,
+        "-filter_complex",
+        filter_graph,
+        "-map",
+        "[v]",
+        "-map",
+        "[a]",
+        *encoder.video_args(lossless, "intermediate", framerate=framerate),
+        *conforming_stream_args(),
+        "-vsync",
+        "cfr",
+        "-r",
+        str(framerate),
+        *AUDIO_CODEC_ARGS,
+        output_path,
+    ]
+
+    result = run_instrumented(
+        "conform", ffmpeg_command, inputs=[input_path], outputs=[output_path]
     )
 
-    if os.path.exists(input_file.replace(".mp4", ".lock")):
-        os.remove(input_file.replace(".mp4", ".lock"))
+    if result.returncode != 0:
+        print(f"Error conforming video {input_path}: {result.stderr.decode()}")
+        raise RuntimeError(
+            f"ffmpeg command failed with return code {result.returncode}"
+        )
+
+
+def find_nonconforming_clips(config, video_files):
+    """
+    Return the clips that cannot be joined by stream copy with the others.
+
+    The reference is the most common set of stream parameters among clips with
+    the configured size, so the SPS/PPS of the majority wins.
+    """
+    cache_dir = os.path.join(config.get("cache_dir", "cache"), "probe")
+    metadata = {f: probe_video(f, cache_dir=cache_dir) for f in video_files}
+
+    def usable(m):
+        video = m.video_stream
+        audio = m.audio_stream
+        return (
+            m.starts_with_keyframe
+            and m.rotation == 0
+            and video.width == config["width"]
+            and video.height == config["height"]
+            and round(video.framerate, 3) == round(config["framerate"], 3)
+            and video.pix_fmt == "yuv420p"
+            and audio is not None
+            and audio.sample_rate == 44100
+            and audio.channels == 2
+        )
+
+    signatures = Counter(clip_signature(m) for m in metadata.values() if usable(m))
+    if not signatures:
+        return list(video_files), metadata
+
+    reference = signatures.most_common(1)[0][0]
+    nonconforming = [
+        f
+        for f, m in metadata.items()
+        if not usable(m) or clip_signature(m) != reference
+    ]
+    return nonconforming, metadata
+
+
+def conform_clips(config, video_files, delete_intermediate_files=True):
+    """
+    Re-encode only the clips that do not match the others. Returns the list of
+    files to join, in the same order.
+    """
+    nonconforming, metadata = find_nonconforming_clips(config, video_files)
+    if not nonconforming:
+        return list(video_files)
+
+    print(f"\nRe-encoding {len(nonconforming)} clip(s) that cannot be stream copied")
+    conformed_files = []
+    for video_file in video_files:
+        if video_file not in nonconforming:
+            conformed_files.append(video_file)
+            continue
+        conformed_file = re.sub(r"\.(mp4|MP4)$", "_conformed.mp4", video_file)
+        conform_clip(
+            video_file,
+            conformed_file,
+            config,
+            metadata[video_file],
+            lossless=config["lossless_aux"],
+        )
+        if delete_intermediate_files:
+            os.remove(video_file)
+        conformed_files.append(conformed_file)
+    return conformed_files
 
 
 def merge_videos(
@@ -390,42 +591,150 @@ def merge_videos(
     output_combined_video="tmp/combined_video.mp4",
     delete_intermediate_files=True,
     lossless=True,
+    mode=None,
+    preview=False,
+    fragmented=False,
 ):
+    """
+    Join the processed clips in index order.
+
+    In "copy" mode the clips are joined by stream copy, re-encoding only those
+    that don't match the rest; in "reencode" mode the whole video is encoded
+    again with the `lossless` quality. With `preview`, join the preview clips
+    instead. With `fragmented`, the output is a fragmented MP4 that can be
+    read while it is being written, made in a single encode.
+    """
+    if preview:
+        config = preview_config(config)
+    if mode is None:
+        mode = config.get("merge_mode", "reencode")
 
+    suffix = "preview" if preview else "processed"
     video_files = [
         f
         for f in os.listdir(folder_path)
-        if re.match(r"\d+_processed\.(mp4|MP4|mpd|MPD)", f)
+        if re.match(rf"\d+_{suffix}\.(mp4|MP4|mpd|MPD)", f)
     ]
     video_files.sort(key=lambda f: int(re.match(r"(\d+)", f).group(1)))
-    processed_files = []
+    processed_files = [f"{folder_path}/{video_file}" for video_file in video_files]
 
-    for i, video_file in enumerate(video_files):
-        processed_file = f"{folder_path}/{video_file}"
-        processed_file = processed_file[len("tmp/") :]
-        processed_files.append(processed_file)
+    if mode == "copy":
+        processed_files = conform_clips(
+            config, processed_files, delete_intermediate_files
+        )
+        if find_nonconforming_clips(config, processed_files)[0]:
+            print("\nClips still differ after conforming, re-encoding everything")
+            mode = "reencode"
+
+    # Paths in the list are relative to the list itself, which goes next to
+    # the output so that merges in different workspaces don't clash
+    list_file = os.path.join(
+        os.path.dirname(output_combined_video),
+        "previews_to_merge.txt" if preview else "videos_to_merge.txt",
+    )
+    # A streamed merge is a single encode, so that the download follows it
+    # from the start rather than waiting for every segment
+    segments = split_into_segments(
+        config, processed_files, None if fragmented else config.get("merge_segments")
+    )
+
+    if mode == "copy":
+        # The combined video is about the size of the clips
+        size = sum(os.path.getsize(video_file) for video_file in processed_files)
+    else:
+        # Encoded again at `lossless`, usually far smaller than the clips
+        cache_dir = os.path.join(config.get("cache_dir", "cache"), "probe")
+        seconds = sum(
+            probe_video(video_file, cache_dir=cache_dir).duration or 0
+            for video_file in processed_files
+        )
+        size = estimate_render_bytes(
+            seconds, config["width"], config["height"], config["framerate"], lossless
+        )
+    with disk_space(config).reserve(size, output_combined_video):
+        if mode == "copy" or len(segments) == 1:
+            write_list_file(list_file, processed_files)
+            if mode == "copy":
+                # Every clip already has the same parameters, so just join the
+                # streams
+                ffmpeg_command = concat_copy_command(
+                    list_file, output_combined_video, fragmented
+                )
+            else:
+                ffmpeg_command = reencode_command(
+                    config, list_file, output_combined_video, lossless, fragmented
+                )
+            run_merge_command(ffmpeg_command, processed_files, output_combined_video)
+        else:
+            # Encode the segments in parallel, then join them by stream copy.
+            # The segments are gone once joined, so they go to the scratch
+            # space if it has room for them, about the size of the video
+            with scratch_space(config).directory(
+                size, os.path.dirname(output_combined_video) or "."
+            ) as segments_dir:
+                segment_files = encode_segments(
+                    config, segments, segments_dir, lossless
+                )
+                write_list_file(list_file, segment_files)
+                run_merge_command(
+                    concat_copy_command(list_file, output_combined_video, fragmented),
+                    segment_files,
+                    output_combined_video,
+                )
 
-    with open("tmp/videos_to_merge.txt", "w") as f:
+    if delete_intermediate_files:
         for video_file in processed_files:
-            f.write(f"file '{video_file}'\n")
+            os.remove(video_file)
+        os.remove(list_file)
+
+
+def write_list_file(list_file, video_files):
+    with open(list_file, "w") as f:
+        for video_file in video_files:
+            relative_path = os.path.relpath(video_file, os.path.dirname(list_file))
+            f.write(f"file '{relative_path}'\n")
 
-    # Use ffmpeg to merge the videos with a consistent color format
-    if lossless != False:
-        video_codec = [
-            "-c:v",
-            "h264_nvenc",
-            "-qp",
-            "0" if lossless == True else str(lossless - 1),
-        ]
-    else:
-        video_codec = ["-c:v", "h264_nvenc"]
 
+def movflags_args(fragmented):
+    """
+    Every fragment of a fragmented MP4 carries its own index, so the file can
+    be played while it is written; otherwise the index is moved to the front
+    once the file is complete, for a quick start of playback.
+    """
+    if fragmented:
+        return ["-movflags", "+frag_keyframe+empty_moov+default_base_moof"]
+    return ["-movflags", "+faststart"]
+
+
+def concat_copy_command(list_file, output_file, fragmented=False):
+    return [
+        "ffmpeg",
+        "-y",
+        "-f",
+        "concat",
+        "-safe",
+        "0",
+        "-i",
+        list_file,
+        "-map",
+        "0:v:0",
+        "-map",
+        "0:a:0",
+        "-c",
+        "copy",
+        *movflags_args(fragmented),
+        output_file,
+    ]
+
+
+def reencode_command(config, list_file, output_file, lossless, fragmented=False):
+    # Use ffmpeg to merge the videos with a consistent color format
     framerate = str(config["framerate"])
-    ffmpeg_command = [
+    encoder = encoder_from_config(config)
+    return [
         "ffmpeg",
         "-y",
-        "-hwaccel",
-        "cuda",
+        *encoder.decode_args(),
         "-f",
         "concat",
         "-safe",
@@ -433,9 +742,7 @@ def merge_videos(
         "-fflags",
         "+genpts",
         "-i",
-        "tmp/videos_to_merge.txt",
-        "-preset",
-        "p5",
+        list_file,
         "-vsync",
         "cfr",
         "-r",
@@ -447,29 +754,24 @@ def merge_videos(
         "0:a:0",
         # # Reset timestamps
         # "setpts=PTS-STARTPTS",
-        "-movflags",
-        "+faststart",
+        *movflags_args(fragmented),
         "-vf",
         f"format=yuv420p,fps={framerate}",
-        *video_codec,
-        "-c:a",
-        "aac",
-        "-b:a",
-        "128k",
-        "-ar",
-        "44100",
-        "-ac",
-        "2",
+        *encoder.video_args(lossless, "final"),
+        *AUDIO_CODEC_ARGS,
         "-async",
         "1",
         "-af",
         "aresample=async=1000",
-        output_combined_video,
+        output_file,
     ]
+
+
+def run_merge_command(ffmpeg_command, input_files, output_file, stage="merge"):
     print("\nRunning merge command:")
     print(" ".join(ffmpeg_command))
-    result = subprocess.run(
-        ffmpeg_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    result = run_instrumented(
+        stage, ffmpeg_command, inputs=input_files, outputs=[output_file]
     )
 
     if result.returncode != 0:
@@ -478,13 +780,81 @@ def merge_videos(
             f"ffmpeg merge command failed with return code {result.returncode}"
         )
 
-    if os.path.exists("tmp/process.lock"):
-        os.remove("tmp/process.lock")
 
-    if delete_intermediate_files:
-        for video_file in processed_files:
-            os.remove("tmp/" + video_file)
-        os.remove("tmp/videos_to_merge.txt")
+def split_into_segments(config, video_files, segments):
+    """
+    Split the ordered clips into runs encoded separately: one per month of
+    the diary with "month", `segments` runs of about the same length with a
+    number, or a single one with None.
+    """
+    if not video_files:
+        return [video_files]
+
+    if segments == "month":
+        start_date = datetime(
+            config["start_year"], config["start_month"], config["start_day"]
+        )
+        months = {}
+        for video_file in video_files:
+            index = int(re.match(r"(\d+)", os.path.basename(video_file)).group(1))
+            date = start_date + timedelta(days=index - 1)
+            months.setdefault((date.year, date.month), []).append(video_file)
+        return list(months.values())
+
+    count = min(int(segments or 1), len(video_files))
+    size, extra = divmod(len(video_files), count)
+    runs, start = [], 0
+    for i in range(count):
+        end = start + size + (i < extra)
+        runs.append(video_files[start:end])
+        start = end
+    return runs
+
+
+def encode_segments(config, segments, output_dir, lossless):
+    """
+    Encode each run of clips to its own file, several at once, with the same
+    encoder settings. Returns the segment files in order.
+    """
+    segment_files = []
+    commands = []
+    for i, segment in enumerate(segments):
+        list_file = os.path.join(output_dir, f"segment_{i}.txt")
+        segment_file = os.path.join(output_dir, f"segment_{i}.mp4")
+        write_list_file(list_file, segment)
+        segment_files.append(segment_file)
+        commands.append(
+            (reencode_command(config, list_file, segment_file, lossless), segment)
+        )
+
+    # Hardware encoders only run a few sessions at once (NVENC on consumer
+    # cards refuses more), so they get one segment at a time by default
+    workers = config.get("merge_workers")
+    if workers is None:
+        if encoder_from_config(config).hardware:
+            workers = 1
+        else:
+            workers = config.get("render_workers") or os.cpu_count() or 1
+    print(f"\nEncoding {len(segments)} segments, {workers} at a time")
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    run_merge_command, command, segment, segment_file, "merge_segment"
+                )
+                for (command, segment), segment_file in zip(commands, segment_files)
+            ]
+            for future in futures:
+                future.result()
+    except Exception:
+        for segment_file in segment_files:
+            if os.path.exists(segment_file):
+                os.remove(segment_file)
+        raise
+    finally:
+        for i in range(len(segments)):
+            os.remove(os.path.join(output_dir, f"segment_{i}.txt"))
+    return segment_files
 
 
 if __name__ == "__main__":
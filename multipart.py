@@ -0,0 +1,185 @@
+import os
+import uuid
+import hashlib
+from email.message import Message
+
+
+# Non-file fields are kept in memory, so they must stay small
+MAX_FIELD_SIZE = 1 << 16
+
+
+class UploadedFile:
+    def __init__(self, filename, paths):
+        self.filename = filename
+        self.paths = paths
+        self.size = 0
+        self.sha256 = None
+
+
+def parse_header(value):
+    """
+    Split a header like `form-data; name="file"` into its value and parameters.
+    """
+    message = Message()
+    message["content-type"] = value
+    params = dict(message.get_params()[1:])
+    return message.get_params()[0][0], params
+
+
+def parse_range(header, file_size):
+    """
+    Parse a single-range `Range` header into an inclusive (start, end).
+
+    Returns None when the whole file should be sent and raises ValueError
+    for ranges that can't be satisfied.
+    """
+    if header is None or not header.startswith("bytes=") or "," in header:
+        return None
+
+    start, _, end = header[len("bytes=") :].strip().partition("-")
+    if not start:
+        # A suffix range: the last `end` bytes
+        length = int(end)
+        if length == 0:
+            raise ValueError("Empty suffix range")
+        return max(file_size - length, 0), file_size - 1
+
+    start = int(start)
+    end = min(int(end), file_size - 1) if end else file_size - 1
+    if start >= file_size or start > end:
+        raise ValueError("Range outside of the file")
+    return start, end
+
+
+class _Reader:
+    def __init__(self, rfile, content_length, chunk_size):
+        self.rfile = rfile
+        self.remaining = content_length
+        self.chunk_size = chunk_size
+        self.buffer = b""
+
+    def fill(self):
+        """
+        Read one more chunk into the buffer. Returns False at the end of the body.
+        """
+        if self.remaining <= 0:
+            return False
+        chunk = self.rfile.read(min(self.chunk_size, self.remaining))
+        if not chunk:
+            raise ValueError("Multipart body ended early")
+        self.remaining -= len(chunk)
+        self.buffer += chunk
+        return True
+
+    def read_until(self, delimiter, sink):
+        """
+        Pass everything up to `delimiter` to `sink` and consume the delimiter.
+
+        Only a delimiter-sized tail is held back between chunks, so memory use
+        does not depend on how much data comes before the delimiter.
+        """
+        while True:
+            position = self.buffer.find(delimiter)
+            if position != -1:
+                sink(self.buffer[:position])
+                self.buffer = self.buffer[position + len(delimiter) :]
+                return
+            keep = len(delimiter) - 1
+            if len(self.buffer) > keep:
+                sink(self.buffer[: len(self.buffer) - keep])
+                self.buffer = self.buffer[len(self.buffer) - keep :]
+            if not self.fill():
+                raise ValueError("Multipart delimiter not found")
+
+    def read_exactly(self, size):
+        while len(self.buffer) < size:
+            if not self.fill():
+                raise ValueError("Multipart body ended early")
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def parse_multipart(rfile, boundary, content_length, file_dirs, chunk_size=1 << 20):
+    """
+    Parse a multipart/form-data body, streaming file parts straight to disk.
+
+    Every file part is written in `chunk_size` pieces to a new temporary file
+    in each of `file_dirs` and hashed on the way, so memory use stays constant
+    whatever the size of the upload. Returns the text fields and the
+    UploadedFile of each file field; the caller moves the files into place.
+    """
+    if isinstance(boundary, str):
+        boundary = boundary.encode("utf-8")
+    reader = _Reader(rfile, content_length, chunk_size)
+
+    fields = {}
+    files = {}
+
+    try:
+        # Skip the preamble up to the first boundary
+        reader.read_until(b"--" + boundary, lambda data: None)
+        delimiter = b"\r\n--" + boundary
+
+        while reader.read_exactly(2) != b"--":
+            headers = []
+            reader.read_until(b"\r\n\r\n", headers.append)
+            part_headers = {}
+            for line in b"".join(headers).decode("utf-8").split("\r\n"):
+                if ":" in line:
+                    key, value = line.split(":", 1)
+                    part_headers[key.strip().lower()] = value.strip()
+
+            _, params = parse_header(part_headers.get("content-disposition", ""))
+            name = params.get("name")
+
+            if "filename" in params:
+                for file_dir in file_dirs:
+                    os.makedirs(file_dir, exist_ok=True)
+                upload = UploadedFile(
+                    params["filename"],
+                    [
+                        os.path.join(file_dir, f".upload-{uuid.uuid4().hex}.part")
+                        for file_dir in file_dirs
+                    ],
+                )
+                sha256 = hashlib.sha256()
+                outputs = [open(path, "wb") for path in upload.paths]
+                try:
+                    def write(data):
+                        sha256.update(data)
+                        upload.size += len(data)
+                        for output in outputs:
+                            output.write(data)
+
+                    reader.read_until(delimiter, write)
+                except Exception:
+                    for output in outputs:
+                        output.close()
+                    for path in upload.paths:
+                        os.remove(path)
+                    raise
+                for output in outputs:
+                    output.close()
+                upload.sha256 = sha256.hexdigest()
+                files[name] = upload
+            else:
+                value = []
+
+                def collect(data):
+                    value.append(data)
+                    if sum(len(v) for v in value) > MAX_FIELD_SIZE:
+                        raise ValueError(f"Multipart field {name} is too large")
+
+                reader.read_until(delimiter, collect)
+                fields[name] = b"".join(value).decode("utf-8")
+
+        # Consume the epilogue so the connection can be reused
+        while reader.fill():
+            reader.buffer = b""
+    except Exception:
+        for upload in files.values():
+            for path in upload.paths:
+                os.remove(path)
+        raise
+
+    return fields, files
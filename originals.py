@@ -0,0 +1,95 @@
+import os
+import re
+import uuid
+import shutil
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from probe import hash_file, remember_hash
+
+
+# ioctl asking Linux filesystems such as Btrfs and XFS to share the extents
+# of a file with another one (copy-on-write)
+FICLONE = 0x40049409
+
+SHA256_PATTERN = re.compile(r"[0-9a-f]{64}")
+
+
+def clone_file(source, destination):
+    """
+    Make `destination` a copy of `source` without duplicating its bytes where
+    the filesystem allows it: a hard link, or else a reflink, and only
+    otherwise a full copy. The destination is replaced atomically.
+
+    Hard links are safe here because the pipeline never writes to a file in
+    place: it writes new files and deletes old ones, and the outputs of
+    ffmpeg, which would write into them, are deleted before each run.
+    """
+    tmp_file = f"{destination}.{uuid.uuid4().hex}.tmp"
+    try:
+        os.link(source, tmp_file)
+    except OSError:
+        try:
+            if fcntl is None:
+                raise OSError("No reflinks on this platform")
+            with open(source, "rb") as src, open(tmp_file, "wb") as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            shutil.copyfile(source, tmp_file)
+    os.replace(tmp_file, destination)
+
+
+class OriginalsStore:
+    """
+    Original clips stored once by content hash, under `objects/` in the
+    originals folder, however many days or sessions they are uploaded for.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.objects_path = os.path.join(path, "objects")
+        self.lock = threading.Lock()
+
+    def object_path(self, content_hash):
+        return os.path.join(
+            self.objects_path, content_hash[:2], f"{content_hash}.mp4"
+        )
+
+    def has(self, content_hash):
+        return os.path.exists(self.object_path(content_hash))
+
+    def add(self, file, content_hash):
+        """
+        Store a file known to have this hash, unless it is already stored.
+        """
+        object_file = self.object_path(content_hash)
+        with self.lock:
+            if os.path.exists(object_file):
+                return object_file
+            os.makedirs(os.path.dirname(object_file), exist_ok=True)
+            clone_file(file, object_file)
+        remember_hash(object_file, content_hash)
+        return object_file
+
+    def adopt(self, files):
+        """
+        Add files saved before the store existed, such as originals copied
+        by earlier versions, hashing each of them. Slow, so best run in the
+        background.
+        """
+        for file in files:
+            if os.path.isfile(file):
+                self.add(file, hash_file(file))
+
+    def save(self, file, content_hash, destination):
+        """
+        Store a file and make `destination` a copy of it sharing its bytes.
+        """
+        object_file = self.add(file, content_hash)
+        os.makedirs(os.path.dirname(destination) or ".", exist_ok=True)
+        clone_file(object_file, destination)
+        remember_hash(destination, content_hash)
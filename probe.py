@@ -0,0 +1,309 @@
+import os
+import json
+import hashlib
+import threading
+from dataclasses import dataclass, field, asdict
+
+from instrumentation import run_instrumented
+
+
+PROBE_CACHE_DIR = "cache/probe"
+
+# Bump when the fields stored in the probe cache change
+PROBE_CACHE_VERSION = 2
+
+HDR_COLOR_PRIMARIES = ["bt2020"]
+HDR_COLOR_TRANSFERS = ["smpte2084", "arib-std-b67"]
+HDR_COLOR_SPACES = ["bt2020_ncl", "bt2020_cl"]
+
+# In-memory caches, so a file is neither hashed nor loaded twice per process
+_hash_cache = {}
+_metadata_cache = {}
+_cache_lock = threading.Lock()
+
+
+@dataclass
+class StreamInfo:
+    index: int
+    codec_type: str
+    codec_name: str = ""
+    profile: str = ""
+    pix_fmt: str = ""
+    extradata_hash: str = ""
+    width: int = 0
+    height: int = 0
+    framerate: float = 0.0
+    sample_rate: int = 0
+    channels: int = 0
+    channel_layout: str = ""
+
+
+@dataclass
+class VideoMetadata:
+    path: str
+    content_hash: str
+    duration: float
+    width: int
+    height: int
+    rotation: int = 0
+    framerate: float = 0.0
+    color_primaries: str = ""
+    color_transfer: str = ""
+    color_space: str = ""
+    has_audio: bool = False
+    starts_with_keyframe: bool = False
+    streams: list = field(default_factory=list)
+    keyframes: list = field(default_factory=list)
+    # Loudness measured by loudnorm, by part of the video ("start-end")
+    loudness: dict = field(default_factory=dict)
+
+    @property
+    def is_hdr(self):
+        return (
+            self.color_primaries in HDR_COLOR_PRIMARIES
+            or self.color_transfer in HDR_COLOR_TRANSFERS
+            or self.color_space in HDR_COLOR_SPACES
+        )
+
+    @property
+    def display_width(self):
+        return self.height if self.rotation in [90, -90, 270, -270] else self.width
+
+    @property
+    def display_height(self):
+        return self.width if self.rotation in [90, -90, 270, -270] else self.height
+
+    @property
+    def video_stream(self):
+        return next(
+            (stream for stream in self.streams if stream.codec_type == "video"), None
+        )
+
+    @property
+    def audio_stream(self):
+        return next(
+            (stream for stream in self.streams if stream.codec_type == "audio"), None
+        )
+
+    def to_dict(self):
+        data = asdict(self)
+        del data["path"]
+        return data
+
+    @classmethod
+    def from_dict(cls, path, data):
+        data = dict(data)
+        data["streams"] = [StreamInfo(**stream) for stream in data["streams"]]
+        data["loudness"] = dict(data.get("loudness", {}))
+        return cls(path=path, **data)
+
+
+def hash_file(path, chunk_size=1 << 20):
+    """
+    Compute the SHA-256 of a file, reusing the result while the file is unchanged.
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _cache_lock:
+        if key in _hash_cache:
+            return _hash_cache[key]
+
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            sha256.update(chunk)
+    content_hash = sha256.hexdigest()
+
+    with _cache_lock:
+        _hash_cache[key] = content_hash
+    return content_hash
+
+
+def remember_hash(path, content_hash):
+    """
+    Record the hash of a file that was already hashed while being written.
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _cache_lock:
+        _hash_cache[key] = content_hash
+
+
+def _parse_rate(rate):
+    try:
+        numerator, denominator = rate.split("/")
+        return int(numerator) / int(denominator) if int(denominator) else 0.0
+    except (AttributeError, ValueError):
+        return 0.0
+
+
+def _parse_rotation(stream):
+    for side_data in stream.get("side_data_list", []):
+        if "rotation" in side_data:
+            return int(side_data["rotation"])
+    try:
+        return int(stream.get("tags", {}).get("rotate", 0))
+    except ValueError:
+        return 0
+
+
+def _run_ffprobe(input_path):
+    # A single ffprobe call covering everything the pipeline needs
+    result = run_instrumented(
+        "probe",
+        [
+            "ffprobe",
+            "-v",
+            "error",
+            "-show_data_hash",
+            "sha256",
+            "-show_entries",
+            "format=duration"
+            ":stream=index,codec_type,codec_name,profile,pix_fmt,extradata_hash,"
+            "width,height,avg_frame_rate,r_frame_rate,color_primaries,color_transfer,color_space,sample_rate,channels,channel_layout"
+            ":stream_side_data=rotation"
+            ":stream_tags=rotate"
+            ":packet=stream_index,pts_time,flags",
+            "-of",
+            "json",
+            input_path,
+        ],
+        inputs=[input_path],
+    )
+
+    if result.returncode != 0:
+        print(f"Error probing video {input_path}: {result.stderr.decode()}")
+        raise RuntimeError(
+            f"ffprobe command failed with return code {result.returncode}"
+        )
+
+    return json.loads(result.stdout.decode())
+
+
+def _parse_ffprobe_output(input_path, content_hash, probe):
+    streams = []
+    video_stream = None
+    for stream in probe.get("streams", []):
+        info = StreamInfo(
+            index=int(stream.get("index", len(streams))),
+            codec_type=stream.get("codec_type", ""),
+            codec_name=stream.get("codec_name", ""),
+            profile=str(stream.get("profile", "")),
+            pix_fmt=stream.get("pix_fmt", ""),
+            extradata_hash=stream.get("extradata_hash", ""),
+            width=int(stream.get("width", 0)),
+            height=int(stream.get("height", 0)),
+            framerate=_parse_rate(stream.get("avg_frame_rate"))
+            or _parse_rate(stream.get("r_frame_rate")),
+            sample_rate=int(stream.get("sample_rate", 0)),
+            channels=int(stream.get("channels", 0)),
+            channel_layout=stream.get("channel_layout", ""),
+        )
+        streams.append(info)
+        if video_stream is None and info.codec_type == "video":
+            video_stream = stream
+
+    if video_stream is None:
+        raise RuntimeError(f"No video stream found in {input_path}")
+
+    video_index = int(video_stream.get("index", 0))
+    video_packets = [
+        packet
+        for packet in probe.get("packets", [])
+        if int(packet.get("stream_index", -1)) == video_index
+    ]
+    keyframes = [
+        float(packet["pts_time"])
+        for packet in video_packets
+        if "K" in packet.get("flags", "")
+        and packet.get("pts_time") not in (None, "N/A")
+    ]
+
+    try:
+        duration = float(probe.get("format", {}).get("duration", 0))
+    except ValueError:
+        duration = 0.0
+
+    return VideoMetadata(
+        path=input_path,
+        content_hash=content_hash,
+        duration=duration,
+        width=int(video_stream.get("width", 0)),
+        height=int(video_stream.get("height", 0)),
+        rotation=_parse_rotation(video_stream),
+        framerate=_parse_rate(video_stream.get("avg_frame_rate"))
+        or _parse_rate(video_stream.get("r_frame_rate")),
+        color_primaries=video_stream.get("color_primaries", ""),
+        color_transfer=video_stream.get("color_transfer", ""),
+        color_space=video_stream.get("color_space", ""),
+        has_audio=any(stream.codec_type == "audio" for stream in streams),
+        starts_with_keyframe=bool(video_packets)
+        and "K" in video_packets[0].get("flags", ""),
+        streams=streams,
+        keyframes=sorted(keyframes),
+    )
+
+
+def probe_video(input_path, cache_dir=PROBE_CACHE_DIR):
+    """
+    Probe a video once and return its metadata.
+
+    Results are cached on disk by content hash, so the same bytes are never
+    probed twice, even across runs and file names.
+    """
+    content_hash = hash_file(input_path)
+
+    with _cache_lock:
+        if content_hash in _metadata_cache:
+            return VideoMetadata.from_dict(input_path, _metadata_cache[content_hash])
+
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, f"{content_hash}.json")
+        if os.path.exists(cache_file):
+            try:
+                with open(cache_file) as f:
+                    cached = json.load(f)
+                if cached.get("version") == PROBE_CACHE_VERSION:
+                    with _cache_lock:
+                        _metadata_cache[content_hash] = cached["metadata"]
+                    return VideoMetadata.from_dict(input_path, cached["metadata"])
+            except (ValueError, KeyError, TypeError):
+                pass  # Corrupt or outdated cache entry; probe again
+
+    metadata = _parse_ffprobe_output(
+        input_path, content_hash, _run_ffprobe(input_path)
+    )
+
+    with _cache_lock:
+        _metadata_cache[content_hash] = metadata.to_dict()
+
+    if cache_file is not None:
+        _write_cache_entry(cache_dir, content_hash, metadata.to_dict())
+
+    return metadata
+
+
+def _write_cache_entry(cache_dir, content_hash, data):
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_file = os.path.join(cache_dir, f"{content_hash}.json")
+    # Write atomically so concurrent workers never read a partial entry
+    tmp_file = f"{cache_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump({"version": PROBE_CACHE_VERSION, "metadata": data}, f)
+    os.replace(tmp_file, cache_file)
+
+
+def remember_loudness(metadata, key, loudness, cache_dir=PROBE_CACHE_DIR):
+    """
+    Store the loudness measured in a part of a video with its metadata, so
+    that it is never measured again.
+    """
+    metadata.loudness[key] = loudness
+    with _cache_lock:
+        data = _metadata_cache.get(metadata.content_hash) or metadata.to_dict()
+        data = {**data, "loudness": {**data.get("loudness", {}), key: loudness}}
+        _metadata_cache[metadata.content_hash] = data
+        # Under the lock, so that concurrent measurements don't drop each other
+        if cache_dir is not None:
+            _write_cache_entry(cache_dir, metadata.content_hash, data)
@@ -0,0 +1,216 @@
+"""
+Rebuild the diary offline from saved originals, without the server.
+
+Every day found in the originals folder (saved as <index>.mp4) is rendered on
+a pool of workers, then the clips are merged like the server does. Partial
+rebuilds only render the days asked for; with a diary store the other days
+come from the store, otherwise only those days are merged:
+
+    python rebuild.py
+    python rebuild.py --only 1-31,45
+    python rebuild.py --from 200 --originals saved/originals
+"""
+
+import os
+import re
+import time
+import shutil
+import argparse
+import threading
+
+import yaml
+from tqdm import tqdm
+
+from probe import hash_file
+from labels import resolve_font
+from originals import clone_file
+from render_pool import RenderPool
+from merge_videos import merge_videos
+from diary_store import DiaryStore, merge_into_diary
+
+
+ORIGINAL_PATTERN = re.compile(r"(\d+)\.(mp4|MP4|mov|MOV)$")
+
+
+def parse_indices(value):
+    """
+    Parse day indices such as "1-31,45" into a set.
+    """
+    indices = set()
+    try:
+        for part in value.split(","):
+            start, _, end = part.strip().partition("-")
+            indices.update(range(int(start), int(end or start) + 1))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid day indices {value}")
+    return indices
+
+
+def find_originals(path, only=None, first=None):
+    """
+    The original of each day in the folder, by index, restricted to the days
+    in `only` and from `first` on if given.
+    """
+    originals = {}
+    for file in os.listdir(path):
+        if (match := ORIGINAL_PATTERN.match(file)) is None:
+            continue
+        index = int(match.group(1))
+        if (only is None or index in only) and (first is None or index >= first):
+            originals[index] = os.path.join(path, file)
+    return dict(sorted(originals.items()))
+
+
+class Throughput:
+    """
+    Aggregate rendering speed, shown next to the progress bar.
+    """
+
+    def __init__(self, total):
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.source_bytes = 0
+        self.progress_bar = tqdm(total=total, desc="Rendered", unit="clip")
+
+    def update(self, source_bytes):
+        with self.lock:
+            self.source_bytes += source_bytes
+            elapsed = time.monotonic() - self.start
+            self.progress_bar.update(1)
+            self.progress_bar.set_postfix_str(
+                f"{self.progress_bar.n / elapsed * 60:.1f} clips/min,"
+                f" {self.source_bytes / elapsed / 1_000_000:.1f} MB/s of source"
+            )
+
+    def close(self):
+        self.progress_bar.close()
+        return time.monotonic() - self.start
+
+
+def rebuild(config, originals_path, output_file, only=None, first=None, workers=None):
+    originals = find_originals(originals_path, only, first)
+    if not originals:
+        raise RuntimeError(f"No originals to rebuild in {originals_path}")
+    print(f"Rebuilding {len(originals)} days from {originals_path}")
+
+    # Not a valid session id, so no session of the server can use it
+    work_path = os.path.join(config.get("workspace_dir", "tmp"), ".rebuild")
+    uploads_path = os.path.join(work_path, "uploads")
+    shutil.rmtree(work_path, ignore_errors=True)
+    os.makedirs(uploads_path)
+
+    store = None
+    source_hashes = {}
+    if config.get("diary_store") is not None:
+        store = DiaryStore(config["diary_store"], config)
+
+    # The originals are linked into the workspace rather than copied, and the
+    # clips are rendered next to the links. Symbolic links work across
+    # filesystems; only where they can't be made (Windows without the right
+    # privilege) do the originals get cloned
+    jobs = {}
+    for index, original in originals.items():
+        if store is not None:
+            source_hashes[index] = hash_file(original)
+            if store.has_clip(index, source_hashes[index]):
+                continue
+        video_file = os.path.join(uploads_path, f"{index}.mp4")
+        try:
+            os.symlink(os.path.abspath(original), video_file)
+        except OSError:
+            clone_file(original, video_file)
+        jobs[index] = os.path.getsize(video_file)
+    if len(jobs) < len(originals):
+        print(f"{len(originals) - len(jobs)} days are already in the diary store")
+
+    throughput = Throughput(len(jobs))
+    render_pool = RenderPool(
+        config,
+        workers=workers or config.get("render_workers"),
+        max_retries=config.get("render_retries", 1),
+        on_complete=lambda job: throughput.update(jobs[job.index]),
+    )
+    for index in jobs:
+        render_pool.submit(os.path.join(uploads_path, f"{index}.mp4"), index)
+    render_pool.wait()
+    elapsed = throughput.close()
+
+    source_mb = sum(jobs.values()) / 1_000_000
+    print(
+        f"Rendered {len(jobs)} clips ({source_mb:.0f} MB) in {elapsed:.1f} s:"
+        f" {len(jobs) / max(elapsed, 1e-9) * 60:.1f} clips/min,"
+        f" {source_mb / max(elapsed, 1e-9):.1f} MB/s"
+    )
+    if failed := render_pool.failed():
+        print(
+            "Merging without videos that failed to render: "
+            + ", ".join(str(job.index) for job in failed)
+        )
+
+    os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)
+    if store is not None:
+        merge_into_diary(
+            store,
+            folder_path=uploads_path,
+            output_combined_video=output_file,
+            source_hashes=source_hashes,
+        )
+    else:
+        merge_videos(
+            config,
+            folder_path=uploads_path,
+            output_combined_video=output_file,
+            delete_intermediate_files=config["delete_intermediate_files"],
+            lossless=config["lossless"],
+        )
+    print(f"Combined video written to {output_file}")
+
+    if config["delete_intermediate_files"]:
+        shutil.rmtree(work_path, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--config", default="config.yaml")
+    parser.add_argument(
+        "--originals", help="folder of <index>.mp4 originals (copy_original_files_to)"
+    )
+    parser.add_argument("--output", help="combined video (save_result_to/result.mp4)")
+    parser.add_argument(
+        "--only", type=parse_indices, help="days to rebuild, such as 1-31,45"
+    )
+    parser.add_argument(
+        "--from", dest="first", type=int, help="rebuild from this day on"
+    )
+    parser.add_argument("--workers", type=int, help="clips rendered in parallel")
+    args = parser.parse_args()
+
+    config = yaml.safe_load(open(args.config))
+    # Look the font up once rather than for every clip
+    config["font"] = resolve_font(config["font"])
+    # Nothing to preview offline, so full renders get the whole CPU
+    config["preview_height"] = None
+
+    originals_path = args.originals or config.get("copy_original_files_to")
+    if originals_path is None:
+        parser.error("--originals is required without copy_original_files_to")
+    partial = args.only is not None or args.first is not None
+    if partial and config.get("diary_store") is None and args.output is None:
+        # Only the days asked for are merged, which must not replace the diary
+        parser.error("--output is required for a partial rebuild without a store")
+    output_file = args.output or os.path.join(
+        config.get("save_result_to") or ".", "result.mp4"
+    )
+
+    rebuild(
+        config,
+        originals_path,
+        output_file,
+        only=args.only,
+        first=args.first,
+        workers=args.workers,
+    )
+
+
+if __name__ == "__main__":
+    main()
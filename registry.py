@@ -0,0 +1,16 @@
+import threading
+
+
+_instances = {}
+_lock = threading.Lock()
+
+
+def shared(cls, *args):
+    """
+    The instance of `cls` made with these arguments, made on first use and
+    then shared by everything asking for the same one.
+    """
+    with _lock:
+        if (cls, args) not in _instances:
+            _instances[(cls, args)] = cls(*args)
+        return _instances[(cls, args)]
@@ -0,0 +1,139 @@
+import os
+import hashlib
+import threading
+
+from originals import clone_file
+from registry import shared
+
+
+# Bump when the way clips are rendered changes, so older renders aren't reused
+RENDER_CACHE_VERSION = 1
+
+
+class RenderCache:
+    """
+    Rendered clips kept by a key covering everything that affects them (the
+    content of the source and the render settings), so the same render is
+    never done twice.
+
+    The cache holds at most `limit_bytes`; past that, the clips used least
+    recently are evicted. The modification time of each file is its last use,
+    so the order survives restarts.
+    """
+
+    def __init__(self, path, limit_bytes):
+        self.path = path
+        self.limit_bytes = limit_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # Last use and size of each cached clip, by key
+        self.entries = {}
+        if os.path.isdir(path):
+            for directory, _, files in os.walk(path):
+                for file in files:
+                    if file.endswith(".mp4"):
+                        stat = os.stat(os.path.join(directory, file))
+                        self.entries[file[: -len(".mp4")]] = (
+                            stat.st_mtime,
+                            stat.st_size,
+                        )
+
+    def _path(self, key):
+        return os.path.join(self.path, key[:2], f"{key}.mp4")
+
+    def get(self, key, destination):
+        """
+        Make `destination` a copy of the clip cached under `key`. Returns
+        whether there was one.
+        """
+        cached_file = self._path(key)
+        with self.lock:
+            if key not in self.entries or not os.path.exists(cached_file):
+                self.entries.pop(key, None)
+                self.misses += 1
+                return False
+            self.hits += 1
+            os.utime(cached_file)
+            self.entries[key] = (os.stat(cached_file).st_mtime, self.entries[key][1])
+            clone_file(cached_file, destination)
+        return True
+
+    def put(self, key, file):
+        """
+        Cache a rendered clip, evicting the least recently used ones if the
+        cache gets over its limit.
+        """
+        size = os.path.getsize(file)
+        if size > self.limit_bytes:
+            return
+        cached_file = self._path(key)
+        with self.lock:
+            os.makedirs(os.path.dirname(cached_file), exist_ok=True)
+            clone_file(file, cached_file)
+            os.utime(cached_file)
+            self.entries[key] = (os.stat(cached_file).st_mtime, size)
+
+            used_bytes = sum(size for _, size in self.entries.values())
+            self._evict(used_bytes - self.limit_bytes, keep=key)
+
+    def _evict(self, size, keep=None, linked=True):
+        freed = 0
+        for key, (_, evicted_size) in sorted(
+            self.entries.items(), key=lambda item: item[1][0]
+        ):
+            if freed >= size:
+                break
+            if key == keep:
+                continue
+            try:
+                if not linked and os.stat(self._path(key)).st_nlink > 1:
+                    continue
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+            del self.entries[key]
+            freed += evicted_size
+            self.evictions += 1
+        return freed
+
+    def evict(self, size):
+        """
+        Evict the least recently used clips until `size` bytes of disk space
+        are freed. Clips linked elsewhere are kept, as removing them frees
+        nothing. Returns the bytes freed.
+        """
+        with self.lock:
+            return self._evict(size, linked=False)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "clips": len(self.entries),
+                "bytes": sum(size for _, size in self.entries.values()),
+            }
+
+
+def render_key(content_hash, *settings):
+    """
+    The cache key of the render of a source with these settings.
+    """
+    return hashlib.sha256(
+        repr((RENDER_CACHE_VERSION, content_hash, *settings)).encode()
+    ).hexdigest()
+
+
+def render_cache(config):
+    """
+    The render cache set in the config, or None when it is disabled.
+    """
+    limit_bytes = int(config.get("render_cache_limit_mb") or 0) << 20
+    if not limit_bytes:
+        return None
+    path = os.path.join(config.get("cache_dir", "cache"), "renders")
+    return shared(RenderCache, path, limit_bytes)
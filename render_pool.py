@@ -0,0 +1,220 @@
+import os
+import threading
+import traceback
+from collections import deque
+
+from merge_videos import process_a_video
+
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class RenderJob:
+    def __init__(self, index, input_file, group=None, config=None, preview=False):
+        self.index = index
+        self.input_file = input_file
+        self.group = group
+        self.config = config
+        self.preview = preview
+        self.status = QUEUED
+        self.attempts = 0
+        self.error = None
+        self.result = None
+
+
+class RenderPool:
+    """
+    A bounded pool of worker threads rendering clips with process_a_video.
+
+    Each job is retried on its own up to `max_retries` times before being
+    marked as failed; a failing clip never blocks the rest of the queue.
+
+    Jobs belong to a group (e.g. a session) and the workers take them from
+    the groups in turn, so a large batch doesn't hold back a smaller one
+    submitted after it. Queries take a group, or cover every job without one.
+
+    Preview renders are taken before any full render. The upload a clip is
+    rendered from is deleted once the last job needing it is done.
+    """
+
+    def __init__(
+        self, config, workers=None, max_retries=1, on_start=None, on_complete=None
+    ):
+        self.config = config
+        self.workers = workers or os.cpu_count() or 1
+        self.max_retries = max_retries
+        self.on_start = on_start
+        self.on_complete = on_complete
+
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.work = threading.Condition(self.lock)
+        # Queued jobs of each group by priority, and for each priority the
+        # groups in the order of their turns
+        self.queues = {}
+        self.turns = {}
+
+        for _ in range(self.workers):
+            threading.Thread(target=self._worker, daemon=True).start()
+
+    def submit(self, input_file, index, group=None, config=None, preview=False):
+        """
+        Queue a clip for rendering, with `config` instead of the pool's own,
+        or for a preview render with `preview`.
+        """
+        index = int(index)
+        job = RenderJob(index, input_file, group, config, preview)
+        with self.lock:
+            self.jobs[(group, index, preview)] = job
+            self._enqueue(job)
+        return job
+
+    def _enqueue(self, job):
+        priority = 1 if job.preview else 0
+        key = (priority, job.group)
+        if key not in self.queues:
+            self.queues[key] = deque()
+            self.turns.setdefault(priority, deque()).append(job.group)
+        self.queues[key].append(job)
+        self.work.notify()
+
+    def _next_job(self):
+        self.work.wait_for(lambda: self.turns)
+        priority = max(self.turns)
+        turns = self.turns[priority]
+        group = turns.popleft()
+        jobs = self.queues[(priority, group)]
+        job = jobs.popleft()
+        if jobs:
+            turns.append(group)
+        else:
+            del self.queues[(priority, group)]
+        if not turns:
+            del self.turns[priority]
+        return job
+
+    def _worker(self):
+        while True:
+            with self.lock:
+                job = self._next_job()
+                job.status = RUNNING
+                job.attempts += 1
+            if self.on_start is not None:
+                self._callback(self.on_start, job)
+
+            try:
+                result = process_a_video(
+                    job.input_file,
+                    job.index,
+                    job.config or self.config,
+                    preview=job.preview,
+                )
+            except Exception as e:
+                with self.lock:
+                    job.error = e
+                    retry = job.attempts <= self.max_retries
+                    job.status = QUEUED if retry else FAILED
+                    if retry:
+                        self._enqueue(job)
+                if retry:
+                    print(f"Rendering video {job.index} failed, retrying: {e}")
+                    continue
+                print(f"Rendering video {job.index} failed for good:")
+                traceback.print_exception(e)
+            else:
+                with self.lock:
+                    job.status = DONE
+                    job.error = None
+                    job.result = result
+
+            config = job.config or self.config
+            with self.lock:
+                input_used = self._input_used(job)
+            if config["delete_intermediate_files"] and not input_used:
+                try:
+                    os.remove(job.input_file)
+                except FileNotFoundError:
+                    # Deleted by the other job of the clip finishing meanwhile
+                    pass
+
+            if self.on_complete is not None:
+                self._callback(self.on_complete, job)
+            with self.lock:
+                self.idle.notify_all()
+
+    def _input_used(self, job):
+        # The upload is kept until its clip is fully rendered, and until then
+        # for retries; a preview still to come needs it as well
+        full = self.jobs.get((job.group, job.index, False))
+        preview = self.jobs.get((job.group, job.index, True))
+        return (
+            full is None
+            or full.status != DONE
+            or (preview is not None and preview.status in [QUEUED, RUNNING])
+        )
+
+    def _callback(self, callback, job):
+        # A failing callback must not take the worker down with it
+        try:
+            callback(job)
+        except Exception as e:
+            print(f"Callback for video {job.index} failed:")
+            traceback.print_exception(e)
+
+    def forget(self, group):
+        """
+        Drop the queued jobs of a group and stop tracking its jobs. Jobs
+        already running still finish.
+        """
+        with self.lock:
+            for priority, turns in list(self.turns.items()):
+                if self.queues.pop((priority, group), None) is not None:
+                    turns.remove(group)
+                    if not turns:
+                        del self.turns[priority]
+            for key in [key for key in self.jobs if key[0] == group]:
+                del self.jobs[key]
+            self.idle.notify_all()
+
+    def _jobs(self, group, preview=None):
+        return [
+            job
+            for (job_group, _, job_preview), job in sorted(
+                self.jobs.items(), key=lambda item: (item[0][1], item[0][2])
+            )
+            if (group is None or job_group == group)
+            and (preview is None or job_preview == preview)
+        ]
+
+    def counts(self, group=None):
+        """
+        Number of jobs in each status.
+        """
+        with self.lock:
+            counts = {status: 0 for status in [QUEUED, RUNNING, DONE, FAILED]}
+            for job in self._jobs(group):
+                counts[job.status] += 1
+            return counts
+
+    def results(self, group=None, preview=False):
+        """
+        All full render jobs (or preview ones) in index order.
+        """
+        with self.lock:
+            return self._jobs(group, preview)
+
+    def failed(self, group=None, preview=False):
+        return [job for job in self.results(group, preview) if job.status == FAILED]
+
+    def wait(self, group=None):
+        """
+        Block until every submitted job is done or has failed.
+        """
+        with self.lock:
+            self.idle.wait_for(
+                lambda: all(job.status in [DONE, FAILED] for job in self._jobs(group))
+            )
@@ -0,0 +1,65 @@
+import os
+import uuid
+import shutil
+import threading
+from contextlib import contextmanager
+
+from registry import shared
+
+
+class ScratchSpace:
+    """
+    A size-limited directory for short-lived files, meant to be on a
+    RAM-backed filesystem such as /dev/shm so that they never reach the disk.
+
+    Space is reserved up front; when the scratch space is full (or there is
+    none), files go to a directory on disk instead.
+    """
+
+    def __init__(self, path, limit_bytes):
+        self.path = path
+        self.limit_bytes = limit_bytes
+        self.used_bytes = 0
+        self.lock = threading.Lock()
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    def _reserve(self, size):
+        if self.path is None:
+            return False
+        with self.lock:
+            if self.used_bytes + size > self.limit_bytes:
+                return False
+            if shutil.disk_usage(self.path).free < size:
+                return False
+            self.used_bytes += size
+            return True
+
+    @contextmanager
+    def directory(self, size, fallback_dir):
+        """
+        A new directory for about `size` bytes of files, removed with its
+        content afterwards.
+        """
+        reserved = self._reserve(size)
+        directory = os.path.join(
+            self.path if reserved else fallback_dir, f"scratch-{uuid.uuid4().hex}"
+        )
+        os.makedirs(directory)
+        try:
+            yield directory
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+            if reserved:
+                with self.lock:
+                    self.used_bytes -= size
+
+
+def scratch_space(config):
+    """
+    The scratch space set in the config. Merges running at the same time
+    get the same one, so that they all count against its limit.
+    """
+    path = config.get("scratch_dir")
+    limit_bytes = int(config.get("scratch_limit_mb", 2048)) << 20
+    return shared(ScratchSpace, path, limit_bytes)
@@ -1,17 +1,28 @@
-from http.server import BaseHTTPRequestHandler, HTTPServer
-import cgi
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import os
-import shutil
 import mimetypes
 import time
-from pathlib import Path
 import threading
 import yaml
 import socket
-from tqdm import tqdm
 import urllib
-
-from merge_videos import process_a_video, merge_videos
+import json
+
+from render_pool import RenderPool
+from labels import resolve_font
+from multipart import parse_header, parse_multipart, parse_range
+from originals import SHA256_PATTERN
+from instrumentation import metrics
+from render_cache import render_cache
+from workspace import disk_space
+import jobs
+from session import (
+    DEFAULT_SESSION,
+    SESSION_ID_PATTERN,
+    Session,
+    check_overrides,
+    load_sessions,
+)
 
 
 # To avoid printing HTTP requests
@@ -35,156 +46,629 @@ def get_lan_ip():
 
 
 config = yaml.safe_load(open("config.yaml"))
+# Look the font up once rather than for every clip
+config["font"] = resolve_font(config["font"])
+metrics.set_log_file(config.get("metrics_log"))
+
+# Uploads received at the same time; further ones are asked to retry later
+upload_slots = threading.BoundedSemaphore(config.get("max_concurrent_uploads", 4))
+uploads_lock = threading.Lock()
+uploads_in_progress = 0
+
+# Longest a long-poll or a download request may wait for a change, in seconds
+MAX_WAIT_SECONDS = 300
+# How often a streamed download checks the combined video for new data
+STREAM_POLL_SECONDS = 0.5
+
+# Sessions being worked on, by id
+sessions = {}
+sessions_lock = threading.Lock()
+
+
+def on_video_started(job):
+    if (session := sessions.get(job.group)) is not None:
+        session.on_video_started(job)
+
+
+def on_video_processed(job):
+    if (session := sessions.get(job.group)) is not None:
+        session.on_video_processed(job)
+
+
+# A single pool for all sessions, taking their clips in turn
+render_pool = RenderPool(
+    config,
+    workers=config.get("render_workers"),
+    max_retries=config.get("render_retries", 1),
+    on_start=on_video_started,
+    on_complete=on_video_processed,
+)
+
+
+def reclaim_space(size):
+    """
+    Delete files nothing needs anymore to free up to `size` bytes: previews of
+    sessions with their combined video ready, then clips of the render cache.
+    """
+    freed = 0
+    with sessions_lock:
+        current_sessions = list(sessions.values())
+    for session in current_sessions:
+        if freed >= size:
+            return freed
+        freed += session.release_space()
+    if freed < size and (cache := render_cache(config)) is not None:
+        freed += cache.evict(size - freed)
+    return freed
+
+
+disk_space(config).reclaimers.append(reclaim_space)
+
+
+def progress_bar_position():
+    # Two lines per session, reusing those of finished sessions
+    positions = {session.position for session in sessions.values()}
+    position = 0
+    while position in positions:
+        position += 2
+    return position
+
+
+def parse_manifest(value):
+    """
+    Parse a plan manifest, a JSON object mapping each clip index to the
+    SHA-256 of its content. Returns None without a manifest.
+    """
+    if value is None:
+        return None
+    try:
+        manifest = {
+            int(index): content_hash.lower()
+            for index, content_hash in json.loads(value).items()
+        }
+    except (ValueError, AttributeError):
+        raise ValueError("The manifest must map clip indices to SHA-256 hashes")
+    for content_hash in manifest.values():
+        if not SHA256_PATTERN.fullmatch(content_hash):
+            raise ValueError(f"Invalid SHA-256 hash {content_hash}")
+    return manifest
+
+
+def get_session(session_id, overrides=None):
+    """
+    The session with this id, started if needed. Settings can only be
+    changed before the first clip of a session is received.
+    """
+    with sessions_lock:
+        session = sessions.get(session_id)
+        if session is None:
+            session = Session(
+                session_id,
+                config,
+                render_pool,
+                overrides=overrides,
+                position=progress_bar_position(),
+            )
+            sessions[session_id] = session
+        elif overrides is not None and overrides != session.overrides:
+            if session.tracker.clips:
+                raise ValueError(
+                    f"Session {session_id} has already started with other settings"
+                )
+            session.configure(overrides)
+        return session
 
-# Shared progress variables
-processing_lock = threading.Lock()
-progress_lock = threading.Lock()
-total_received = 0
-total_completed = 0
-total_files = None
 
-# TQDM progress bars
-progress_bar_received = None
-progress_bar_completed = None
+def end_session(session):
+    with sessions_lock:
+        sessions.pop(session.id, None)
+    session.finish()
 
 
 class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
+    def endpoint(self):
+        """
+        The path of the request, without the query, which holds the session
+        id chosen by the client, nor a trailing slash.
+        """
+        return urllib.parse.urlparse(self.path).path.rstrip("/") or "/"
+
+    def session_id(self):
+        """
+        The session of the request, from its `session` query parameter or its
+        X-Session-Id header, or the default session.
+        """
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        session_id = (
+            query.get("session", [None])[0]
+            or self.headers.get("X-Session-Id")
+            or DEFAULT_SESSION
+        )
+        if not SESSION_ID_PATTERN.fullmatch(session_id):
+            raise ValueError(f"Invalid session id {session_id}")
+        return session_id
+
     def do_POST(self):
-        global total_files, total_received, total_completed, progress_bar_received, progress_bar_completed
+        global uploads_in_progress
 
-        if "plan" in self.path:  # Request sent as a form with num={number of files}
-            global total_files
+        try:
+            session_id = self.session_id()
+        except ValueError as e:
+            self.send_response(400)
+            self.end_headers()
+            self.wfile.write(str(e).encode("utf-8"))
+            return
 
+        # Request sent as a form with num={number of files}, and optionally
+        # settings of the session such as start_year=2025 and a manifest of
+        # the clips as JSON {index: sha256}
+        if self.endpoint() == "/plan":
             content_length = int(self.headers.get("Content-Length", 0))
             post_data = self.rfile.read(content_length).decode("utf-8")
             form_data = urllib.parse.parse_qs(post_data)
-            total_files = int(form_data["num"][0])
-
+            try:
+                num = form_data.get("num", [""])[0]
+                if not num.isdigit():
+                    raise ValueError(f"Invalid number of files num={num}")
+                total = int(num)
+                overrides = {}
+                for key, values in form_data.items():
+                    if key not in ["num", "manifest"]:
+                        try:
+                            overrides[key] = yaml.safe_load(values[0])
+                        except yaml.YAMLError:
+                            raise ValueError(f"Invalid value for {key}: {values[0]}")
+                check_overrides(overrides)
+                manifest = parse_manifest(form_data.get("manifest", [None])[0])
+                session = get_session(session_id, overrides or None)
+            except ValueError as e:
+                self.send_response(409 if "already started" in str(e) else 400)
+                self.end_headers()
+                self.wfile.write(str(e).encode("utf-8"))
+                return
+            session.plan(total)
+
+            if manifest is None:
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write("Received".encode("utf-8"))
+                return
+
+            # Reply with the clips to upload; the others are taken from what
+            # the server already has
+            needed = session.negotiate(manifest)
+            print(
+                f"{len(manifest) - len(needed)} of {len(manifest)} clips are"
+                " already on the server"
+            )
             self.send_response(200)
+            self.send_header("Content-type", "application/json")
             self.end_headers()
-            self.wfile.write("Received".encode("utf-8"))
+            self.wfile.write(json.dumps({"needed": needed}).encode("utf-8"))
             return
 
-        ctype, pdict = cgi.parse_header(self.headers.get("Content-Type"))
+        ctype, pdict = parse_header(self.headers.get("Content-Type", ""))
         if ctype == "multipart/form-data":
-            pdict["boundary"] = bytes(pdict["boundary"], "utf-8")
-            fields = cgi.parse_multipart(self.rfile, pdict)
-            file_data = fields.get("file")[0]
-
-            file_index = fields.get("index")[0]
+            if "Content-Length" not in self.headers:
+                self.send_response(411)
+                self.end_headers()
+                self.wfile.write(b"Content-Length required")
+                return
+            if not pdict.get("boundary"):
+                self.close_connection = True
+                self.send_response(400)
+                self.end_headers()
+                self.wfile.write(b"Multipart boundary missing")
+                return
+
+            try:
+                content_length = int(self.headers["Content-Length"])
+                if content_length < 0:
+                    raise ValueError
+            except ValueError:
+                self.close_connection = True
+                self.send_response(400)
+                self.end_headers()
+                self.wfile.write(b"Invalid Content-Length")
+                return
+
+            # Refuse uploads the disk has no room for, rather than fill it up
+            # and fail halfway through rendering
+            disk = disk_space(config)
+            reservation = disk.try_reserve(content_length)
+            if reservation is None:
+                self.close_connection = True
+                self.send_response(503)
+                self.send_header(
+                    "Retry-After", str(config.get("disk_retry_seconds", 60))
+                )
+                self.end_headers()
+                self.wfile.write(b"Not enough disk space, try again later")
+                return
+
+            try:
+                if not upload_slots.acquire(
+                    timeout=config.get("upload_wait_seconds", 30)
+                ):
+                    # The body is left unread, so the connection can't be reused
+                    self.close_connection = True
+                    self.send_response(503)
+                    self.send_header("Retry-After", "10")
+                    self.end_headers()
+                    self.wfile.write(b"Too many uploads at once, try again later")
+                    return
+
+                with uploads_lock:
+                    uploads_in_progress += 1
+                try:
+                    self.receive_upload(get_session(session_id), pdict["boundary"])
+                finally:
+                    with uploads_lock:
+                        uploads_in_progress -= 1
+                    upload_slots.release()
+            finally:
+                disk.release(reservation)
+        else:
+            self.send_response(400)
+            self.end_headers()
+            self.wfile.write(b"Bad request")
 
-            os.makedirs("tmp/uploads", exist_ok=True)
+    def receive_upload(self, session, boundary):
+        # Stream the file to the session's uploads folder
+        try:
+            fields, files = parse_multipart(
+                self.rfile,
+                boundary,
+                int(self.headers["Content-Length"]),
+                [session.uploads_path],
+            )
+            file_index = int(fields["index"])
+            upload = files["file"]
+        except (ValueError, KeyError, TypeError) as e:
+            # What is left of the body can't be told apart from a new request
+            self.close_connection = True
+            self.send_response(400)
+            self.end_headers()
+            self.wfile.write(f"Malformed upload: {e}".encode("utf-8"))
+            return
+        session.receive(file_index, upload)
 
-            video_file = f"tmp/uploads/{file_index}.mp4"
-            with open(video_file, "wb") as f:
-                f.write(file_data)
+        self.send_response(200)
+        self.end_headers()
+        formatted_str = f"File {file_index} uploaded successfully"
+        self.wfile.write(formatted_str.encode("utf-8"))
+
+    def send_file(self, file_path, content_type):
+        """
+        Send a file with support for HTTP ranges, without loading it in memory.
+
+        Returns True when the whole file was sent.
+        """
+        file_size = os.path.getsize(file_path)
+        try:
+            byte_range = parse_range(self.headers.get("Range"), file_size)
+        except ValueError:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{file_size}")
+            self.end_headers()
+            return False
 
-            # Save the originals if set in the config
-            if (originals_path := config.get("copy_original_files_to")) is not None:
-                os.makedirs(originals_path, exist_ok=True)
-                new_video_file = f"{originals_path}/{file_index}.mp4"
-                shutil.copyfile(video_file, new_video_file)
+        start, end = byte_range or (0, file_size - 1)
+        if byte_range is None:
+            self.send_response(200)
+        else:
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{file_size}")
+        self.send_header("Content-type", content_type)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        self.wfile.flush()
+
+        with open(file_path, "rb") as file:
+            offset, remaining = start, end - start + 1
+            try:
+                # Let the kernel copy straight from the file to the socket
+                while remaining > 0:
+                    sent = os.sendfile(
+                        self.connection.fileno(), file.fileno(), offset, remaining
+                    )
+                    if sent == 0:
+                        break
+                    offset += sent
+                    remaining -= sent
+            except ConnectionError:
+                raise
+            except (AttributeError, OSError):
+                # No sendfile on this platform or socket; copy in chunks
+                file.seek(offset)
+                while remaining > 0:
+                    chunk = file.read(min(1 << 20, remaining))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    remaining -= len(chunk)
+        return byte_range is None and remaining == 0
 
-            Path(video_file.replace(".mp4", ".lock")).touch()
-            threading.Thread(
-                target=self.process_video, args=(video_file, file_index)
-            ).start()
+    def do_GET(self):
+        if self.endpoint() == "/metrics":
+            counts = render_pool.counts()
+            with uploads_lock:
+                uploads = uploads_in_progress
+            with sessions_lock:
+                states = [
+                    session.tracker.snapshot()["state"] for session in sessions.values()
+                ]
+            gauges = {
+                "sessions": len(states),
+                "render_queue_depth": counts["queued"],
+                "renders_running": counts["running"],
+                "renders_done": counts["done"],
+                "renders_failed": counts["failed"],
+                "uploads_in_progress": uploads,
+                "merging": states.count(jobs.MERGING),
+                "disk_available_bytes": disk_space(config).available(),
+            }
+            if (cache := render_cache(config)) is not None:
+                for name, value in cache.stats().items():
+                    gauges[f"render_cache_{name}"] = value
+            body = metrics.render(gauges)
+            self.send_response(200)
+            self.send_header("Content-type", "text/plain; version=0.0.4")
+            self.end_headers()
+            self.wfile.write(body.encode("utf-8"))
+            return
 
-            if progress_bar_completed is None:
-                progress_bar_received = tqdm(
-                    total=total_files, desc=" Received", position=0
-                )
-                progress_bar_completed = tqdm(
-                    total=total_files, desc="Completed", position=1
-                )
+        try:
+            session_id = self.session_id()
+        except ValueError as e:
+            self.send_response(400)
+            self.end_headers()
+            self.wfile.write(str(e).encode("utf-8"))
+            return
+        session = sessions.get(session_id)
+        if session is None:
+            self.send_response(404)
+            self.end_headers()
+            self.wfile.write(f"Unknown session {session_id}".encode("utf-8"))
+            return
+        tracker = session.tracker
 
-            with progress_lock:
-                total_received += 1
-                progress_bar_received.update(1)
+        if self.endpoint() == "/done":
+            end_session(session)
 
             self.send_response(200)
             self.end_headers()
-            formatted_str = f"File {file_index} uploaded successfully"
-            self.wfile.write(formatted_str.encode("utf-8"))
-        else:
-            self.send_response(400)
-            self.end_headers()
-            self.wfile.write(b"Bad request")
+            self.wfile.write(b"Done")
 
-    def process_video(self, video_file, file_index):
-        global total_completed, progress_bar_completed
-        with processing_lock:
-            process_a_video(video_file, int(file_index), config)
+            print(f"Sent the finished video of session {session.id}")
+            return
 
-        with progress_lock:
-            total_completed += 1
-            progress_bar_completed.update(1)
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        try:
+            # With ?since=<version>, wait for the next change (long-polling)
+            since = int(query["since"][0]) if "since" in query else None
+            timeout = float(query.get("timeout", [30])[0])
+            # With ?wait=<seconds>, answer as soon as the video is ready rather
+            # than telling the client to come back later
+            wait = float(query.get("wait", [0])[0])
+            if not (timeout >= 0 and wait >= 0):
+                raise ValueError
+        except ValueError:
+            self.send_response(400)
+            self.end_headers()
+            self.wfile.write(b"since must be an integer, timeout and wait seconds")
+            return
+        timeout = min(timeout, MAX_WAIT_SECONDS)
+        deadline = time.monotonic() + min(wait, MAX_WAIT_SECONDS)
 
-    def do_GET(self):
-        if "done" in self.path:
-            if (save_path := config["save_result_to"]) is not None:
-                os.makedirs(save_path, exist_ok=True)
-                shutil.copyfile("tmp/combined_video.mp4", f"{save_path}/result.mp4")
-
-            if config["delete_intermediate_files"]:
-                for file in os.listdir("tmp/uploads"):
-                    os.remove(f"tmp/uploads/{file}")
-                os.remove("tmp/combined_video.mp4")
-                os.rmdir("tmp/uploads")
-                os.rmdir("tmp")
+        if self.endpoint() == "/events":
+            self.stream_events(tracker)
+            return
 
+        if self.endpoint() == "/status":
+            status = tracker.wait(since, timeout)
             self.send_response(200)
+            self.send_header("Content-type", "application/json")
             self.end_headers()
-            self.wfile.write(b"Done")
+            self.wfile.write(json.dumps(status).encode("utf-8"))
+            return
+
+        def remaining():
+            return max(deadline - time.monotonic(), 0)
 
-            print("Sent the finished video. My work is now complete :)")
-            exit(0)
+        if self.endpoint() == "/preview":
+            self.send_preview(session, remaining())
             return
 
-        if any([file.endswith(".lock") for file in os.listdir("tmp/uploads")]):
+        if not tracker.wait_until(tracker.can_merge, remaining()):
             self.send_response(202)
             self.end_headers()
             self.wfile.write(b"Processing individual videos...")
             return
 
-        file_path = "tmp/combined_video.mp4"
-        if os.path.exists(file_path) and not os.path.exists("tmp/process.lock"):
-            self.send_response(200)
-            self.send_header("Content-type", "video/mp4")
-            self.end_headers()
-            with open(file_path, "rb") as file:
-                self.wfile.write(file.read())
-            filesize_in_mb = os.path.getsize(file_path) // 1_000_000
-            print(f"Combined video file size: {filesize_in_mb} MB")
+        session.start_merge()
+        # A whole download can follow the merge as it writes the video
+        if (
+            session.streams_merge
+            and "Range" not in self.headers
+            and self.stream_merge(session)
+        ):
+            return
+        tracker.wait_until(
+            lambda: tracker.merge_state in [jobs.READY, jobs.FAILED], remaining()
+        )
+        status = tracker.snapshot()
+
+        if status["state"] == jobs.READY:
+            file_path = session.combined_video
+            if self.send_file(file_path, "video/mp4"):
+                filesize_in_mb = os.path.getsize(file_path) // 1_000_000
+                print(f"Combined video file size: {filesize_in_mb} MB")
             return
 
-        if os.path.exists("tmp/process.lock"):
-            self.send_response(202)
+        if status["state"] == jobs.FAILED:
+            # The next request starts the merge again
+            self.send_response(500)
             self.end_headers()
-            self.wfile.write(b"Processing, try again in 1 minute")
-            return
-
-        if progress_bar_received:
-            progress_bar_received.close()
-            progress_bar_completed.close()
-        Path("tmp/process.lock").touch()
-        threading.Thread(
-            target=merge_videos,
-            kwargs={
-                "config": config,
-                "output_combined_video": file_path,
-                "delete_intermediate_files": config["delete_intermediate_files"],
-                "lossless": config["lossless"],
-            },
-        ).start()
+            self.wfile.write(f"Merging failed: {status['error']}".encode("utf-8"))
+            return
+
         self.send_response(202)
         self.end_headers()
-        self.wfile.write(b"Processing started, try again in 1 minute")
+        self.wfile.write(b"Processing, try again in 1 minute")
+
+    def stream_merge(self, session):
+        """
+        Send the combined video as the merge writes it, a fragmented MP4 that
+        plays while it grows, so that the download overlaps with the merge.
+
+        Returns False without sending anything when the merge is over before
+        the video is created; it is then sent like any other file.
+        """
+        tracker = session.tracker
+        # A merge done again with more clips writes a new file, not this one
+        merge_count = tracker.merge_count
+
+        def merging():
+            return (
+                tracker.merge_state == jobs.MERGING
+                and tracker.merge_count == merge_count
+            )
+
+        # The video is only created once the clips to merge are ready
+        while not os.path.exists(session.combined_video):
+            if not merging():
+                return False
+            tracker.wait_until(lambda: not merging(), STREAM_POLL_SECONDS)
+
+        # The size isn't known yet: HTTP/1.1 clients get the video in chunks,
+        # others until the connection is closed
+        chunked = self.request_version == "HTTP/1.1"
+        if chunked:
+            self.protocol_version = "HTTP/1.1"
+        self.send_response(200)
+        self.send_header("Content-type", "video/mp4")
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        with open(session.combined_video, "rb") as file:
+            while True:
+                # Checked before reading, so that nothing written before the
+                # merge ended is missed
+                finished = not merging()
+                chunk = file.read(1 << 20)
+                if chunk:
+                    if chunked:
+                        self.wfile.write(f"{len(chunk):x}\r\n".encode("ascii"))
+                        self.wfile.write(chunk + b"\r\n")
+                    else:
+                        self.wfile.write(chunk)
+                elif finished:
+                    break
+                else:
+                    tracker.wait_until(lambda: not merging(), STREAM_POLL_SECONDS)
+
+        if tracker.merge_state != jobs.READY or tracker.merge_count != merge_count:
+            # Leave the response unfinished, so the client sees it is broken
+            print(f"Merging failed or changed while streaming session {session.id}")
+            return True
+        if chunked:
+            self.wfile.write(b"0\r\n\r\n")
+        print(f"Streamed the combined video of session {session.id}")
+        return True
+
+    def send_preview(self, session, timeout):
+        """
+        Send the preview of the diary, made of quick low resolution renders of
+        the clips, which is ready well before the combined video.
+        """
+        tracker = session.tracker
+        if not session.previews:
+            self.send_response(404)
+            self.end_headers()
+            self.wfile.write(b"Previews are disabled")
+            return
 
+        # Started here again after a failed merge
+        session.preview_when_finished()
+        tracker.wait_until(
+            lambda: tracker.preview_state in [jobs.READY, jobs.FAILED], timeout
+        )
+        preview = tracker.snapshot()["preview"]
+
+        if preview["state"] == jobs.READY and os.path.exists(session.preview_video):
+            self.send_file(session.preview_video, "video/mp4")
+            return
+
+        if preview["state"] == jobs.READY:
+            self.send_response(410)
+            self.end_headers()
+            self.wfile.write(b"The preview was deleted to free disk space")
+            return
+
+        if preview["state"] == jobs.FAILED:
+            self.send_response(500)
+            self.end_headers()
+            self.wfile.write(f"Merging failed: {preview['error']}".encode("utf-8"))
+            return
+
+        self.send_response(202)
+        self.end_headers()
+        self.wfile.write(b"Rendering the preview, try again in a few seconds")
+
+    def stream_events(self, tracker):
+        """
+        Send the status as Server-Sent Events, one on every change, until the
+        combined video is ready or its merge failed.
+        """
+        self.send_response(200)
+        self.send_header("Content-type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
 
-def run(server_class=HTTPServer, handler_class=SimpleHTTPRequestHandler, port=8080):
+        # Reconnecting clients resume after the last event they got
+        last_event_id = self.headers.get("Last-Event-ID")
+        since = int(last_event_id) if (last_event_id or "").isdigit() else -1
+        try:
+            while True:
+                status = tracker.wait(since, timeout=15)
+                if status["version"] == since:
+                    # Keeps proxies and clients from timing the stream out
+                    self.wfile.write(b": keep-alive\n\n")
+                else:
+                    since = status["version"]
+                    self.wfile.write(
+                        f"id: {since}\nevent: status\ndata: {json.dumps(status)}\n\n".encode(
+                            "utf-8"
+                        )
+                    )
+                if status["state"] == jobs.READY:
+                    self.wfile.write(b"event: ready\ndata: {}\n\n")
+                    self.wfile.flush()
+                    return
+                if status["state"] == jobs.FAILED:
+                    # The client asks for the video again to retry the merge
+                    error = json.dumps({"error": status["error"]})
+                    self.wfile.write(f"event: error\ndata: {error}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+                    return
+                self.wfile.flush()
+        except ConnectionError:
+            pass
+
+
+def run(
+    server_class=ThreadingHTTPServer, handler_class=SimpleHTTPRequestHandler, port=8080
+):
     server_address = ("", port)
     httpd = server_class(server_address, handler_class)
+    # Sessions a previous run of the server didn't finish
+    for session in load_sessions(config, render_pool):
+        sessions[session.id] = session
     print(f"The URL is:\n >>> {get_lan_ip()}:{port} <<<\n")
     httpd.serve_forever()
 
@@ -198,5 +682,5 @@ if __name__ == "__main__":
     try:
         run()
     except KeyboardInterrupt:
-        progress_bar_received.close()
-        progress_bar_completed.close()
+        for session in sessions.values():
+            session.close_progress_bars()
@@ -0,0 +1,585 @@
+import os
+import re
+import shutil
+import threading
+import traceback
+from tqdm import tqdm
+
+import jobs
+from jobs import JobTracker
+from journal import Journal, SessionState, read_records
+from merge_videos import merge_videos
+from diary_store import DiaryStore, merge_into_diary
+from labels import resolve_font
+from probe import remember_hash
+from originals import OriginalsStore, clone_file
+
+
+# The session of requests that don't name one, e.g. from the original shortcut
+DEFAULT_SESSION = "default"
+
+SESSION_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+# Config values a session may set for itself in its plan, with the types
+# they can take. Paths on the server are left out on purpose.
+SESSION_SETTINGS = {
+    "start_day": int,
+    "start_month": int,
+    "start_year": int,
+    "width": int,
+    "height": int,
+    "framerate": (int, float),
+    "font": str,
+    "font_size": int,
+    "lossless": (bool, int),
+    "lossless_aux": (bool, int),
+    "force_video_duration_to_seconds": (int, float, type(None)),
+    "merge_mode": str,
+    "encoder": str,
+    "codec": str,
+    "preview_height": (int, type(None)),
+    "preview_quality": int,
+    "loudness_target": (int, float, type(None)),
+}
+
+
+def check_overrides(overrides):
+    """
+    Raise ValueError for settings a session can't set, or with values of the
+    wrong type.
+    """
+    if unknown := set(overrides) - set(SESSION_SETTINGS):
+        raise ValueError(f"Unknown settings: {', '.join(sorted(unknown))}")
+    for key, value in overrides.items():
+        types = SESSION_SETTINGS[key]
+        types = types if isinstance(types, tuple) else (types,)
+        # YAML reads true and false as booleans, which are also integers
+        if isinstance(value, bool) and bool not in types:
+            raise ValueError(f"Invalid value for {key}: {value}")
+        if not isinstance(value, types):
+            raise ValueError(f"Invalid value for {key}: {value}")
+
+
+def session_path(path, session_id):
+    """
+    Where a session keeps its files in a configured directory. The default
+    session uses the directory itself, as the server did before sessions.
+    """
+    if path is None:
+        return None
+    if session_id == DEFAULT_SESSION:
+        return path
+    return os.path.join(path, session_id)
+
+
+class Session:
+    """
+    One diary being uploaded, rendered and merged, in its own workspace.
+
+    Clips are rendered on the pool shared by all sessions, with the jobs of
+    the session grouped under its id. With preview_height set, each clip also
+    gets a quick preview render, taken before any full render, and the
+    previews are joined into a preview of the diary as soon as they are in.
+    """
+
+    def __init__(self, session_id, config, render_pool, overrides=None, position=0):
+        self.id = session_id
+        self.base_config = config
+        self.render_pool = render_pool
+        self.position = position
+
+        self.path = os.path.join(config.get("workspace_dir", "tmp"), session_id)
+        self.uploads_path = os.path.join(self.path, "uploads")
+        self.combined_video = os.path.join(self.path, "combined_video.mp4")
+        self.preview_video = os.path.join(self.path, "preview_video.mp4")
+        self.originals_path = session_path(
+            config.get("copy_original_files_to"), session_id
+        )
+        self.save_path = session_path(config.get("save_result_to"), session_id)
+        # Originals of every session are stored once, in the shared folder
+        self.originals_store = (
+            OriginalsStore(config["copy_original_files_to"])
+            if config.get("copy_original_files_to") is not None
+            else None
+        )
+
+        self.tracker = JobTracker()
+        self.journal = (
+            Journal(os.path.join(self.path, "journal.jsonl"))
+            if config.get("journal", True)
+            else None
+        )
+        self.source_hashes = {}
+        self.configure(overrides or {})
+
+        # Progress, shown as two bars per session
+        self.lock = threading.Lock()
+        self.total_files = None
+        self.total_received = 0
+        self.total_completed = 0
+        self.progress_bar_received = None
+        self.progress_bar_completed = None
+
+    def configure(self, overrides):
+        """
+        Apply the session's own settings on top of the server config.
+        """
+        self.overrides = overrides
+        self.config = {**self.base_config, **overrides}
+        if "font" in overrides:
+            self.config["font"] = resolve_font(overrides["font"])
+
+        self._diary_store = None
+
+    @property
+    def previews(self):
+        return self.config.get("preview_height") is not None
+
+    @property
+    def streams_merge(self):
+        """
+        Whether the combined video can be downloaded while it is merged. The
+        diary store builds it aside and swaps it in, so it can't.
+        """
+        return (
+            self.config.get("stream_merge", False)
+            and self.config.get("diary_store") is None
+        )
+
+    @property
+    def diary_store(self):
+        """
+        Rendered days kept across sessions of the same id. Only opened once
+        needed, as opening it with other settings than the session's would
+        discard the stored days.
+        """
+        diary_path = session_path(self.config.get("diary_store"), self.id)
+        if diary_path is None:
+            return None
+        with self.lock:
+            if self._diary_store is None:
+                self._diary_store = DiaryStore(diary_path, self.config)
+            return self._diary_store
+
+    def log_event(self, event, **fields):
+        if self.journal is not None:
+            self.journal.append(event, **fields)
+
+    def create_progress_bars(self):
+        prefix = "" if self.id == DEFAULT_SESSION else f"{self.id} "
+        with self.lock:
+            if self.progress_bar_completed is None:
+                self.progress_bar_received = tqdm(
+                    total=self.total_files,
+                    desc=f"{prefix} Received",
+                    position=self.position,
+                )
+                self.progress_bar_completed = tqdm(
+                    total=self.total_files,
+                    desc=f"{prefix}Completed",
+                    position=self.position + 1,
+                )
+
+    def close_progress_bars(self):
+        with self.lock:
+            if self.progress_bar_received:
+                self.progress_bar_received.close()
+                self.progress_bar_completed.close()
+
+    def plan(self, total_files):
+        with self.lock:
+            self.total_files = total_files
+        self.log_event("plan", total=total_files, overrides=self.overrides)
+        self.tracker.set_total(total_files)
+
+    def receive(self, index, upload):
+        """
+        Move a streamed upload into place and queue it for rendering.
+        """
+        video_file = os.path.join(self.uploads_path, f"{index}.mp4")
+        os.replace(upload.paths[0], video_file)
+        remember_hash(video_file, upload.sha256)
+
+        # Save the original if set in the config, sharing the upload's bytes
+        if self.originals_store is not None:
+            self.originals_store.save(
+                video_file,
+                upload.sha256,
+                os.path.join(self.originals_path, f"{index}.mp4"),
+            )
+
+        self._accept(index, video_file, upload.sha256)
+
+    def negotiate(self, manifest):
+        """
+        Take the clips of a plan manifest, {index: sha256}, that the server
+        already has without having them uploaded again. Returns the indices
+        of the clips that still have to be uploaded.
+        """
+        needed = []
+        legacy = []
+        for index, content_hash in sorted(manifest.items()):
+            if self.diary_store is not None and self.diary_store.has_clip(
+                index, content_hash
+            ):
+                # Already rendered into the diary, the original isn't needed
+                self._accept(index, None, content_hash)
+                continue
+
+            if self.originals_store is None:
+                needed.append(index)
+                continue
+            original_file = os.path.join(self.originals_path, f"{index}.mp4")
+            if not self.originals_store.has(content_hash):
+                # Hashing originals saved before the store would hold up the
+                # plan, so they are only added to the store for next time
+                legacy.append(original_file)
+                needed.append(index)
+                continue
+
+            stored_file = self.originals_store.object_path(content_hash)
+            video_file = os.path.join(self.uploads_path, f"{index}.mp4")
+            os.makedirs(self.uploads_path, exist_ok=True)
+            clone_file(stored_file, video_file)
+            remember_hash(video_file, content_hash)
+            self.originals_store.save(stored_file, content_hash, original_file)
+            self._accept(index, video_file, content_hash)
+
+        if legacy:
+            threading.Thread(
+                target=self.originals_store.adopt, args=(legacy,), daemon=True
+            ).start()
+        return needed
+
+    def _accept(self, index, video_file, content_hash):
+        """
+        Queue a received clip for rendering, unless the diary has it already.
+        """
+        self.log_event("upload", index=index, sha256=content_hash)
+
+        already_rendered = False
+        if self.diary_store is not None:
+            self.source_hashes[index] = content_hash
+            already_rendered = self.diary_store.has_clip(index, content_hash)
+
+        self.create_progress_bars()
+        with self.lock:
+            self.total_received += 1
+            self.progress_bar_received.update(1)
+
+        if already_rendered:
+            # This day is already in the stored diary, nothing to render
+            if video_file is not None:
+                os.remove(video_file)
+            with self.lock:
+                self.total_completed += 1
+                self.progress_bar_completed.update(1)
+            self.log_event("rendered", index=index)
+            self.tracker.set_clip(index, jobs.PROCESSED)
+            # Nothing to preview either, the preview goes without this day
+            self.tracker.set_preview(index)
+            self.merge_when_finished()
+            self.preview_when_finished()
+        else:
+            self.tracker.set_clip(index, jobs.RECEIVED)
+            if self.previews:
+                self.render_pool.submit(
+                    video_file, index, group=self.id, config=self.config, preview=True
+                )
+            self.render_pool.submit(
+                video_file, index, group=self.id, config=self.config
+            )
+
+    def on_video_started(self, job):
+        if not job.preview:
+            self.tracker.set_clip(job.index, jobs.PROCESSING)
+
+    def on_video_processed(self, job):
+        if job.preview:
+            # A failed preview is left out of the preview, not retried
+            self.tracker.set_preview(job.index)
+            self.preview_when_finished()
+            return
+
+        with self.lock:
+            self.total_completed += 1
+            self.progress_bar_completed.update(1)
+        if job.error is None:
+            self.log_event("rendered", index=job.index, result=job.result)
+            self.tracker.set_clip(job.index, jobs.PROCESSED, **job.result)
+        else:
+            self.log_event("failed", index=job.index, error=str(job.error))
+            self.tracker.set_clip(job.index, jobs.FAILED, error=job.error)
+        self.merge_when_finished()
+
+    def _run_merge(self, target, **kwargs):
+        try:
+            target(**kwargs)
+        except Exception as e:
+            print(f"Merging the videos of session {self.id} failed:")
+            traceback.print_exception(e)
+            if not self.tracker.finish_merge(e):
+                self.log_event("merge_failed", error=str(e))
+                return
+        else:
+            if not self.tracker.finish_merge():
+                self.log_event("merged")
+                if self.config["delete_intermediate_files"]:
+                    # The preview clips are only needed to merge the preview
+                    # again
+                    self.remove_previews(keep_video=True)
+                return
+        # Clips were received during the merge, which has to be done again
+        # with them; left out of the journal, a restart merges again too
+        print(f"Clips of session {self.id} changed during the merge, merging again")
+        self.merge_when_finished()
+
+    def remove_previews(self, keep_video=False):
+        """
+        Delete the preview clips, and the preview itself unless `keep_video`.
+        Returns the bytes freed.
+        """
+        files = []
+        if os.path.isdir(self.uploads_path):
+            files = [
+                os.path.join(self.uploads_path, file)
+                for file in os.listdir(self.uploads_path)
+                if re.match(r"\d+_preview\.mp4$", file)
+            ]
+        if not keep_video:
+            files.append(self.preview_video)
+
+        freed = 0
+        for file in files:
+            try:
+                size = os.path.getsize(file)
+                os.remove(file)
+            except FileNotFoundError:
+                continue
+            freed += size
+        return freed
+
+    def release_space(self):
+        """
+        Delete the files of the session that nothing needs anymore, for when
+        the disk runs out of space: the previews, once the combined video is
+        ready. Returns the bytes freed.
+        """
+        if self.tracker.merge_state != jobs.READY:
+            return 0
+        return self.remove_previews()
+
+    def start_merge(self):
+        """
+        Merge the rendered clips in the background, unless it is already being
+        done or done already.
+        """
+        if not self.tracker.start_merge():
+            return
+        self.log_event("merge_started")
+        self.close_progress_bars()
+        if failed := self.render_pool.failed(self.id):
+            print(
+                "Merging without videos that failed to render: "
+                + ", ".join(str(job.index) for job in failed)
+            )
+        if session_path(self.config.get("diary_store"), self.id) is not None:
+            # Only days new to the diary get appended to the stored video. The
+            # store is opened by the merge thread, where a failure to do so
+            # fails the merge
+            kwargs = {
+                "target": lambda **kwargs: merge_into_diary(
+                    self.diary_store, **kwargs
+                ),
+                "folder_path": self.uploads_path,
+                "output_combined_video": self.combined_video,
+                "source_hashes": self.source_hashes,
+            }
+        else:
+            kwargs = {
+                "target": merge_videos,
+                "config": self.config,
+                "folder_path": self.uploads_path,
+                "output_combined_video": self.combined_video,
+                # The clips are kept for merging again should more come in;
+                # they go with the workspace once the session is over
+                "delete_intermediate_files": False,
+                "lossless": self.config["lossless"],
+                "fragmented": self.streams_merge,
+            }
+            if self.streams_merge and os.path.exists(self.combined_video):
+                # Downloads stream whatever is in the file, not an old merge
+                os.remove(self.combined_video)
+        try:
+            threading.Thread(target=self._run_merge, kwargs=kwargs).start()
+        except RuntimeError as e:
+            self.log_event("merge_failed", error=str(e))
+            self.tracker.finish_merge(e)
+            raise
+
+    def _run_preview_merge(self):
+        try:
+            merge_videos(
+                self.config,
+                folder_path=self.uploads_path,
+                output_combined_video=self.preview_video,
+                delete_intermediate_files=False,
+                lossless=self.config.get("preview_quality", 30),
+                preview=True,
+            )
+        except Exception as e:
+            print(f"Merging the preview of session {self.id} failed:")
+            traceback.print_exception(e)
+            outdated = self.tracker.finish_preview_merge(e)
+        else:
+            outdated = self.tracker.finish_preview_merge()
+        if outdated:
+            self.preview_when_finished()
+
+    def preview_when_finished(self):
+        # The preview is only kept until the session ends, so it isn't
+        # journaled: a restarted server makes it again
+        if self.tracker.previews_finished() and self.tracker.start_preview_merge():
+            threading.Thread(target=self._run_preview_merge).start()
+
+    def merge_when_finished(self):
+        # Start merging as soon as every planned clip is in, so the combined
+        # video is ready without waiting for the client to ask for it
+        if self.tracker.clips_finished():
+            self.start_merge()
+
+    def resume(self, records):
+        """
+        Pick up the session where it was left when the server stopped, from
+        its journal: clips already rendered are kept, clips received but not
+        rendered are queued again, and an interrupted merge is started again.
+        Clips that never finished uploading have to be sent again.
+        """
+        state = SessionState(records)
+        if state.total is None and not state.uploads:
+            return
+
+        print(f"Resuming session {self.id} from {self.journal.path}")
+        if state.total is not None:
+            self.total_files = state.total
+            self.tracker.set_total(state.total)
+
+        requeued = []
+        previews = []
+        previewed = []
+        for index, source_hash in sorted(state.uploads.items()):
+            video_file = os.path.join(self.uploads_path, f"{index}.mp4")
+            processed_file = os.path.join(self.uploads_path, f"{index}_processed.mp4")
+            preview_file = os.path.join(self.uploads_path, f"{index}_preview.mp4")
+            if self.previews:
+                if not os.path.exists(preview_file) and os.path.exists(video_file):
+                    previews.append((video_file, index))
+                else:
+                    # Rendered already, or there is nothing left to render it
+                    # from
+                    previewed.append(index)
+            if self.diary_store is not None:
+                self.source_hashes[index] = source_hash
+
+            if os.path.exists(processed_file) and (
+                index in state.rendered or not os.path.exists(video_file)
+            ):
+                # The upload is only deleted once its clip is fully rendered
+                self.tracker.set_clip(
+                    index, jobs.PROCESSED, **state.rendered.get(index, {})
+                )
+                self.total_completed += 1
+            elif self.diary_store is not None and self.diary_store.has_clip(
+                index, source_hash
+            ):
+                self.tracker.set_clip(index, jobs.PROCESSED)
+                self.total_completed += 1
+            elif os.path.exists(video_file):
+                remember_hash(video_file, source_hash)
+                self.tracker.set_clip(index, jobs.RECEIVED)
+                requeued.append((video_file, index))
+            else:
+                continue
+            self.total_received += 1
+
+        print(
+            f"{self.total_completed} clips already rendered,"
+            f" {len(requeued)} to render again"
+        )
+        self.create_progress_bars()
+        self.progress_bar_received.update(self.total_received)
+        self.progress_bar_completed.update(self.total_completed)
+
+        if state.merged and os.path.exists(self.combined_video):
+            self.tracker.start_merge()
+            self.tracker.finish_merge()
+        elif state.merge_started and self.tracker.total is None:
+            # Merge the clips there are once they are rendered, as was asked
+            self.tracker.set_total(len(self.tracker.clips))
+
+        for index in previewed:
+            self.tracker.set_preview(index)
+        for video_file, index in previews:
+            self.render_pool.submit(
+                video_file, index, group=self.id, config=self.config, preview=True
+            )
+        for video_file, index in requeued:
+            self.render_pool.submit(
+                video_file, index, group=self.id, config=self.config
+            )
+        self.merge_when_finished()
+        self.preview_when_finished()
+
+    def finish(self):
+        """
+        Save the result and clean the workspace up once the client has the
+        combined video.
+        """
+        if self.save_path is not None and os.path.exists(self.combined_video):
+            os.makedirs(self.save_path, exist_ok=True)
+            shutil.copyfile(
+                self.combined_video, os.path.join(self.save_path, "result.mp4")
+            )
+
+        self.close_progress_bars()
+        self.render_pool.forget(self.id)
+
+        # The session is over, a restart must not resume it
+        if self.journal is not None:
+            self.journal.remove()
+
+        if self.config["delete_intermediate_files"]:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+
+def load_sessions(config, render_pool, first_position=0):
+    """
+    Sessions left with a journal in the workspace directory by a server that
+    stopped, with the settings they were planned with.
+    """
+    workspace_dir = config.get("workspace_dir", "tmp")
+    if not config.get("journal", True) or not os.path.isdir(workspace_dir):
+        return []
+
+    sessions = []
+    for session_id in sorted(os.listdir(workspace_dir)):
+        journal_file = os.path.join(workspace_dir, session_id, "journal.jsonl")
+        if not SESSION_ID_PATTERN.fullmatch(session_id) or not os.path.exists(
+            journal_file
+        ):
+            continue
+        records = read_records(journal_file)
+        overrides = {}
+        for record in records:
+            if record["event"] == "plan":
+                overrides = record.get("overrides") or {}
+        session = Session(
+            session_id,
+            config,
+            render_pool,
+            overrides=overrides,
+            position=first_position + 2 * len(sessions),
+        )
+        session.resume(records)
+        sessions.append(session)
+    return sessions
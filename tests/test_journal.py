@@ -0,0 +1,57 @@
+from journal import Journal, SessionState, read_records
+
+
+def test_replay():
+    state = SessionState(
+        [
+            {"event": "plan", "total": 3},
+            {"event": "upload", "index": 1, "sha256": "a"},
+            {"event": "upload", "index": 2, "sha256": "b"},
+            {"event": "rendered", "index": 1, "result": {"source_range": [0, 1]}},
+            {"event": "rendered", "index": 2},
+            {"event": "merge_started"},
+            {"event": "merged"},
+        ]
+    )
+
+    assert state.total == 3
+    assert state.uploads == {1: "a", 2: "b"}
+    assert state.rendered == {1: {"source_range": [0, 1]}, 2: {}}
+    assert state.merge_started
+    assert state.merged
+
+
+def test_new_upload_replaces_render():
+    state = SessionState(
+        [
+            {"event": "upload", "index": 1, "sha256": "a"},
+            {"event": "rendered", "index": 1},
+            {"event": "merged"},
+            {"event": "upload", "index": 1, "sha256": "c"},
+        ]
+    )
+
+    assert state.uploads == {1: "c"}
+    assert state.rendered == {}
+    assert not state.merged
+
+
+def test_failed_merge():
+    state = SessionState([{"event": "merge_started"}, {"event": "merge_failed"}])
+
+    assert state.merge_started
+    assert not state.merged
+
+
+def test_torn_last_line(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = Journal(path)
+    journal.append("plan", total=2)
+    journal.append("upload", index=1, sha256="a")
+    with open(path, "a") as f:
+        f.write('{"event": "rend')
+
+    assert read_records(path) == [
+        {"event": "plan", "total": 2},
+        {"event": "upload", "index": 1, "sha256": "a"},
+    ]
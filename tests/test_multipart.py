@@ -0,0 +1,109 @@
+import io
+import os
+import hashlib
+
+import pytest
+
+from multipart import parse_multipart, parse_range
+
+
+BOUNDARY = "----boundary1234"
+
+
+def body(*parts):
+    data = b""
+    for headers, content in parts:
+        data += f"--{BOUNDARY}\r\n{headers}\r\n\r\n".encode() + content + b"\r\n"
+    return data + f"--{BOUNDARY}--\r\n".encode()
+
+
+def field(name, value):
+    return (f'Content-Disposition: form-data; name="{name}"', value)
+
+
+def file(name, filename, content):
+    return (
+        f'Content-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+        "Content-Type: video/mp4",
+        content,
+    )
+
+
+def parse(data, tmp_path, chunk_size=1 << 20):
+    return parse_multipart(
+        io.BytesIO(data), BOUNDARY, len(data), [str(tmp_path)], chunk_size
+    )
+
+
+def test_fields_and_file(tmp_path):
+    content = os.urandom(10_000)
+    fields, files = parse(
+        body(field("index", b"12"), file("file", "12.mp4", content)), tmp_path
+    )
+
+    assert fields == {"index": "12"}
+    upload = files["file"]
+    assert upload.filename == "12.mp4"
+    assert upload.size == len(content)
+    assert upload.sha256 == hashlib.sha256(content).hexdigest()
+    with open(upload.paths[0], "rb") as f:
+        assert f.read() == content
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, len(BOUNDARY) + 3])
+def test_boundary_split_across_reads(tmp_path, chunk_size):
+    # The content looks like the start of a delimiter, which must not end it
+    content = b"\r\n--" + BOUNDARY[:-1].encode() + b"\r\n-" * 5
+    fields, files = parse(
+        body(field("index", b"3"), file("file", "3.mp4", content)),
+        tmp_path,
+        chunk_size,
+    )
+
+    assert fields == {"index": "3"}
+    with open(files["file"].paths[0], "rb") as f:
+        assert f.read() == content
+
+
+def test_body_cut_short(tmp_path):
+    data = body(file("file", "1.mp4", b"x" * 1000))
+
+    with pytest.raises(ValueError):
+        parse_multipart(io.BytesIO(data[:500]), BOUNDARY, len(data), [str(tmp_path)])
+    # The partial upload is removed
+    assert os.listdir(tmp_path) == []
+
+
+def test_missing_boundary(tmp_path):
+    data = b"not a multipart body"
+
+    with pytest.raises(ValueError):
+        parse(data, tmp_path)
+
+
+def test_field_too_large(tmp_path):
+    with pytest.raises(ValueError):
+        parse(body(field("index", b"1" * (1 << 17))), tmp_path)
+
+
+@pytest.mark.parametrize(
+    "header, expected",
+    [
+        (None, None),
+        ("bytes=0-99", (0, 99)),
+        ("bytes=100-", (100, 999)),
+        ("bytes=900-5000", (900, 999)),
+        ("bytes=-100", (900, 999)),
+        ("bytes=-5000", (0, 999)),
+        ("bytes=0-1,5-9", None),
+        ("items=0-1", None),
+    ],
+)
+def test_parse_range(header, expected):
+    assert parse_range(header, 1000) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=1000-", "bytes=5-1", "bytes=-0", "bytes=a-"])
+def test_parse_range_unsatisfiable(header):
+    with pytest.raises(ValueError):
+        parse_range(header, 1000)
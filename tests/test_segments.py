@@ -0,0 +1,32 @@
+import pytest
+
+from merge_videos import split_into_segments
+
+
+CONFIG = {"start_year": 2024, "start_month": 1, "start_day": 30}
+
+
+def clips(indices):
+    return [f"tmp/uploads/{index}_processed.mp4" for index in indices]
+
+
+def test_by_month():
+    # Day 1 is January 30th, so days 3 to 31 are in February 2024
+    segments = split_into_segments(CONFIG, clips([1, 2, 3, 31, 32]), "month")
+
+    assert segments == [clips([1, 2]), clips([3, 31]), clips([32])]
+
+
+@pytest.mark.parametrize(
+    "count, sizes", [(None, [7]), (1, [7]), (3, [3, 2, 2]), (10, [1] * 7)]
+)
+def test_by_count(count, sizes):
+    video_files = clips(range(1, 8))
+    segments = split_into_segments(CONFIG, video_files, count)
+
+    assert [len(segment) for segment in segments] == sizes
+    assert sum(segments, []) == video_files
+
+
+def test_no_clips():
+    assert split_into_segments(CONFIG, [], "month") == [[]]
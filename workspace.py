@@ -0,0 +1,144 @@
+import os
+import time
+import shutil
+import threading
+from contextlib import contextmanager
+
+from registry import shared
+
+
+# How often a stage waiting for disk space checks again, in seconds
+SPACE_WAIT_SECONDS = 5
+
+# Bytes per second of the AAC audio of a rendered clip
+AUDIO_BYTES_PER_SECOND = 16_000
+
+
+def estimate_render_bytes(seconds, width, height, framerate, lossless):
+    """
+    A generous estimate of the size of a rendered clip, from its duration,
+    size, frame rate and quality (a `lossless` config value).
+    """
+    if lossless == True:
+        bits_per_pixel = 2.0
+    elif lossless == False:
+        bits_per_pixel = 0.1
+    else:
+        # About 0.1 bits per pixel at CRF 23, doubling every 6 steps down
+        bits_per_pixel = 0.1 * 2 ** ((23 - (lossless - 1)) / 6)
+    video_bytes = seconds * width * height * framerate * bits_per_pixel / 8
+    return int(video_bytes + seconds * AUDIO_BYTES_PER_SECOND)
+
+
+class DiskSpace:
+    """
+    The free space of the disk the workspace is on, shared by the stages
+    writing to it.
+
+    Each stage reserves the space it expects to use before starting, so
+    that stages running at the same time can't overcommit the disk, and at
+    least `min_free_bytes` are always left free. A reservation made for a
+    file only counts what hasn't been written to it yet.
+
+    When space runs out, the reclaimers, functions given a number of bytes
+    to free and returning how many they did, delete files nothing needs
+    anymore. A stage waits at most `max_wait_seconds` for space.
+    """
+
+    def __init__(self, path, min_free_bytes, max_wait_seconds=None):
+        self.path = path
+        self.min_free_bytes = min_free_bytes
+        self.max_wait_seconds = max_wait_seconds
+        self.reclaimers = []
+        self.lock = threading.Lock()
+        self.released = threading.Condition(self.lock)
+        # Reserved bytes, and the file each reservation is for, if any
+        self.reservations = {}
+        os.makedirs(path, exist_ok=True)
+
+    def _outstanding(self):
+        outstanding = 0
+        for size, path in self.reservations.values():
+            written = os.path.getsize(path) if path and os.path.isfile(path) else 0
+            outstanding += max(size - written, 0)
+        return outstanding
+
+    def available(self):
+        """
+        Bytes that can still be reserved.
+        """
+        with self.lock:
+            free = shutil.disk_usage(self.path).free
+            return free - self._outstanding() - self.min_free_bytes
+
+    def reclaim(self, size):
+        freed = 0
+        for reclaimer in list(self.reclaimers):
+            if freed >= size:
+                break
+            freed += reclaimer(size - freed)
+        if freed:
+            print(f"Freed {freed // 1_000_000} MB of files no longer needed")
+        return freed
+
+    def try_reserve(self, size, path=None):
+        """
+        Reserve `size` bytes if there is room for them, freeing space if
+        needed. Returns the reservation, to release once done, or None.
+        """
+        if self.available() < size:
+            self.reclaim(size - self.available())
+        with self.lock:
+            free = shutil.disk_usage(self.path).free
+            if free - self._outstanding() - self.min_free_bytes < size:
+                return None
+            reservation = object()
+            self.reservations[reservation] = (size, path)
+            return reservation
+
+    def release(self, reservation):
+        with self.lock:
+            self.reservations.pop(reservation, None)
+            self.released.notify_all()
+
+    @contextmanager
+    def reserve(self, size, path=None):
+        """
+        Reserve `size` bytes for a stage writing `path`, waiting for space
+        to be freed if there isn't enough, and failing if none is freed in
+        time.
+        """
+        reservation = self.try_reserve(size, path)
+        if reservation is None:
+            print(
+                f"Waiting for {size // 1_000_000} MB of disk space"
+                f" to write {path or 'files'}"
+            )
+        start = time.monotonic()
+        while reservation is None:
+            waited = time.monotonic() - start
+            if self.max_wait_seconds is not None and waited >= self.max_wait_seconds:
+                print(f"Gave up waiting for disk space after {waited:.0f} s")
+                raise RuntimeError(
+                    f"Not enough disk space for {size // 1_000_000} MB"
+                    f" to write {path or 'files'}"
+                )
+            with self.lock:
+                self.released.wait(SPACE_WAIT_SECONDS)
+            reservation = self.try_reserve(size, path)
+        try:
+            yield
+        finally:
+            self.release(reservation)
+
+
+def disk_space(config):
+    """
+    The disk space of the workspace set in the config, the same for every
+    stage so that they see each other's reservations.
+    """
+    path = config.get("workspace_dir", "tmp")
+    min_free_bytes = int(config.get("min_free_space_mb") or 0) << 20
+    return shared(
+        DiskSpace, path, min_free_bytes, config.get("disk_wait_seconds", 600)
+    )